@@ -1,7 +1,15 @@
+import hashlib
+import hmac
+import os
 import random
 import string
 from datetime import datetime
 
+try:
+    import numpy as np
+except ImportError:  # generate_identities falls back to one record at a time
+    np = None
+
 # Names
 # • Address: Including street address, city, county, precinct, and ZIP code done Look at state !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 # • Birthdate done
@@ -55,23 +63,198 @@ counties = ["Jefferson", "Washington", "Franklin", "Madison", "Lincoln", "Hamilt
 precincts = ["North", "South", "East", "West", "Central", "Downtown", "Suburban", "Industrial"]
 zip_codes = [f"{random.randint(10000, 99999)}" for _ in range(50)]  # Generate 50 random ZIP codes
 
-# Set to keep track of assigned fake names (ensures uniqueness)
-used_fake_names = set()
+# Optional extra names (one per line), see use_extra_names
+NAMES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "names.txt")
+
+class GeneratorExhausted(RuntimeError):
+    """Every value of a pseudonym space has been handed out"""
+
+class PermutedSequence:
+    """
+    The integers 0..size-1 in a keyed pseudo-random order, one per call to
+    next(). Position p is mapped through a Feistel permutation of the
+    smallest even-bit domain covering size, walking the cycle until the
+    value falls below size (fewer than 4 steps on average). A draw is O(1)
+    and needs no record of earlier values: the whole state is the seed and
+    the position, kept in a plain dict so it can be persisted.
+    """
+    ROUNDS = 4
+
+    def __init__(self, size, state=None):
+        if state is None:
+            state = {"size": size, "seed": random.getrandbits(64), "position": 0}
+        elif state["size"] != size:
+            raise ValueError(f"generator state is for {state['size']} values, the value space has {size}")
+        self.size = size
+        self.state = state
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+        keys = random.Random(state["seed"])
+        self.keys = [keys.getrandbits(64) for _ in range(self.ROUNDS)]
+
+    def permute(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for key in self.keys:
+            mixed = ((right ^ key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            left, right = right, left ^ ((mixed ^ (mixed >> 29)) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def next(self):
+        position = self.state["position"]
+        if position >= self.size:
+            raise GeneratorExhausted(f"all {self.size} values have been handed out")
+        self.state["position"] = position + 1
+        value = self.permute(position)
+        while value >= self.size:
+            value = self.permute(value)
+        return value
+
+    def permute_array(self, values):
+        """permute() of a uint64 array; multiplication wraps at 64 bits like the masked product"""
+        shift = np.uint64(self.half_bits)
+        mask = np.uint64(self.half_mask)
+        left, right = values >> shift, values & mask
+        for key in self.keys:
+            mixed = (right ^ np.uint64(key)) * np.uint64(0x9E3779B97F4A7C15)
+            left, right = right, left ^ ((mixed ^ (mixed >> np.uint64(29))) & mask)
+        return (left << shift) | right
+
+    def take(self, count):
+        """The next count values as an int64 array, the same values as count calls to next()"""
+        position = self.state["position"]
+        if position + count > self.size:
+            raise GeneratorExhausted(f"{count} values requested, {self.size - position} left")
+        self.state["position"] = position + count
+        values = self.permute_array(np.arange(position, position + count, dtype=np.uint64))
+        outside = np.flatnonzero(values >= self.size)
+        while len(outside):
+            values[outside] = self.permute_array(values[outside])
+            outside = outside[values[outside] >= self.size]
+        return values.astype(np.int64)
+
+# Sizes of the number formats below
+PHONE_SPACE = 900 * 900 * 9000
+SSN_SPACE = 900 * 90 * 9000
+MRN_SPACE = 26 * 9999000
+ACCOUNT_SPACE = 26 * 9900000000
+EMAIL_SUFFIXES = 100
+
+def value_spaces():
+    """Number of distinct values of each pseudonym generator"""
+    names = len(first_names) * len(last_names)
+    return {
+        "name": names,
+        "email": names * EMAIL_SUFFIXES,
+        "phone": PHONE_SPACE,
+        "ssn": SSN_SPACE,
+        "mrn": MRN_SPACE,
+        "account": ACCOUNT_SPACE,
+    }
+
+# Sequence state per value space; a pseudonym store swaps in its own mapping
+generator_state = {}
+sequences = {}
+
+def sequence(space):
+    """The permuted sequence of a value space, continuing from its saved state"""
+    seq = sequences.get(space)
+    if seq is None:
+        seq = PermutedSequence(value_spaces()[space], generator_state.get(space))
+        generator_state[space] = seq.state
+        sequences[space] = seq
+    return seq
+
+def use_generator_state(state):
+    """Continues the sequences from state (e.g. a PatientStore mapping) and saves to it"""
+    global generator_state
+    generator_state = state
+    sequences.clear()
+
+def snapshot_state():
+    return {space: dict(state) for space, state in generator_state.items()}
+
+def restore_state(snapshot):
+    generator_state.clear()
+    generator_state.update({space: dict(state) for space, state in snapshot.items()})
+    sequences.clear()
+
+def use_extra_names(path=NAMES_FILE):
+    """
+    Adds the names of path to both name lists, which multiplies the name
+    space (19,600 names with the built-in lists). Must be called before the
+    first name is drawn, and the same way on every run sharing a store.
+    """
+    with open(path, encoding="utf-8") as file:
+        names = [line.strip().title() for line in file if line.strip()]
+    for name_list in (first_names, last_names):
+        known = set(name_list)
+        for name in names:
+            if name not in known:
+                known.add(name)
+                name_list.append(name)
+    sequences.pop("name", None)
+    sequences.pop("email", None)
+
+def capacity():
+    """(values handed out, capacity) per value space"""
+    return {space: (generator_state.get(space, {}).get("position", 0), size)
+            for space, size in value_spaces().items()}
+
+# Secret key of the keyed-deterministic mode, see use_pseudonym_key
+pseudonym_key = None
 
-def generate_unique_fake_name():
-    """Generates a non-overlapping fake name"""
-    while True:
-        fname = random.choice(first_names)
-        lname = random.choice(last_names)
-        fake_name = fname + " " + lname
-        if fake_name not in used_fake_names:
-            used_fake_names.add(fake_name)
-            return lname, fname
+def use_pseudonym_key(key):
+    """
+    Keyed-deterministic mode: a generator given an identifier (the real
+    value it replaces, or a tuple of parts) derives its fake value from an
+    HMAC-SHA256 of the normalized identifier, so every run and machine with
+    the same key maps the same real value to the same fake one without a
+    lookup table. Unlike the sequences, keyed values are not guaranteed
+    unique: n identifiers in a space of N values share about n*n/2N values.
+    None switches back to the sequences.
+    """
+    global pseudonym_key
+    pseudonym_key = key.encode("utf-8") if isinstance(key, str) else key
 
+def normalize_identifier(identifier):
+    parts = identifier if isinstance(identifier, tuple) else (identifier,)
+    return "\x1f".join(" ".join(str(part).split()).upper() for part in parts)
 
+def keyed_value(space, identifier):
+    """128-bit HMAC value of identifier, separate for each value space"""
+    message = f"{space}\x1e{normalize_identifier(identifier)}".encode("utf-8")
+    return int.from_bytes(hmac.new(pseudonym_key, message, hashlib.sha256).digest()[:16], "big")
+
+def is_keyed(identifier):
+    return pseudonym_key is not None and identifier is not None
+
+def draw(space, identifier=None):
+    """Index into a value space: keyed by identifier in keyed mode, else the next of the sequence"""
+    if is_keyed(identifier):
+        return keyed_value(space, identifier) % value_spaces()[space]
+    return sequence(space).next()
+
+def fake_name_at(index):
+    last_index, first_index = divmod(index, len(first_names))
+    return last_names[last_index], first_names[first_index]
+
+def generate_unique_fake_name(identifier=None):
+    """Generates a non-overlapping fake name (the keyed name of identifier in keyed mode)"""
+    if is_keyed(identifier):
+        return fake_name_at(draw("name", identifier))
+    return fake_name_at(sequence("name").next())
+
+# Date ages are calculated against, fixed on first use so one run uses one date
+today = None
+
+def run_today():
+    global today
+    if today is None:
+        today = datetime.today()
+    return today
 
 def calculate_age(year, month, day):
-    today = datetime.today()
+    today = run_today()
     birth_date = datetime(year, month, day)
     
     age = today.year - birth_date.year
@@ -82,59 +265,56 @@ def calculate_age(year, month, day):
     
     return age
 
-def generate_fake_birthday(original_birthday):
-    """Generates a fake birthday, keep the year"""
+def generate_fake_birthday(original_birthday, identifier=None):
+    """Generates a fake birthday, keep the year (month and day keyed by identifier in keyed mode)"""
     if original_birthday == "":
         return 2000+random.randint(1, 12)+random.randint(1,28)
     year = original_birthday[:4]
     if calculate_age(int(original_birthday[:4]),int(original_birthday[4:6]),int(original_birthday[6:8])) >= 90:
         year = "1935"
-    month = random.randint(1, 12)
-    day = random.randint(1,28)
+    if is_keyed(identifier):
+        month, day = divmod(keyed_value("birthday", identifier) % (12 * 28), 28)
+        month, day = month + 1, day + 1
+    else:
+        month = random.randint(1, 12)
+        day = random.randint(1,28)
     month = f"{month:02}"
     day = f"{day:02}"
     birthday = year+month+day
     return birthday
 
-used_fake_phone_numbers = set()
-
-def generate_phone_number():
-    """Generates a non-overlapping fake name"""
-    while True:
-        fake_number = str(random.randint(100,999))+"-"+str(random.randint(100,999))+"-"+str(random.randint(1000,9999))
-        if fake_number not in used_fake_phone_numbers:
-            used_fake_names.add(fake_number)
-            return fake_number
-
-used_fake_email = set()
-
-def generate_email():
-    """Generates a non-overlapping fake name"""
-    while True:
-        fake_number = str(random.randint(100,999))+"-"+str(random.randint(100,999))+"-"+str(random.randint(1000,9999))
-        if fake_number not in used_fake_phone_numbers:
-            used_fake_names.add(fake_number)
-            return fake_number
-
-def generate_SSN():
-    """Generate random SSN"""
-    SSN = str(random.randint(100,999))+"-"+str(random.randint(10,99))+"-"+str(random.randint(1000,9999))
-    return SSN
-
-def generate_MRN():
-    """generate fake MRN"""
-    letter = chr(random.randint(65, 90))
-    MRN = letter+str(random.randint(1000,9999999))
-    return MRN
+def generate_phone_number(identifier=None):
+    """Generates a non-overlapping fake phone number"""
+    index, line = divmod(draw("phone", identifier), 9000)
+    area, exchange = divmod(index, 900)
+    return f"{area + 100}-{exchange + 100}-{line + 1000}"
+
+def generate_email(identifier=None):
+    """Generates a non-overlapping fake email address"""
+    index, suffix = divmod(draw("email", identifier), EMAIL_SUFFIXES)
+    lname, fname = fake_name_at(index)
+    return f"{fname}.{lname}{suffix}@example.com".lower()
+
+def generate_SSN(identifier=None):
+    """Generate a non-overlapping random SSN"""
+    index, serial = divmod(draw("ssn", identifier), 9000)
+    area, group = divmod(index, 90)
+    return f"{area + 100}-{group + 10}-{serial + 1000}"
+
+def generate_MRN(identifier=None):
+    """generate a non-overlapping fake MRN"""
+    letter, number = divmod(draw("mrn", identifier), 9999000)
+    return chr(65 + letter) + str(1000 + number)
     
-def generate_account_number():
-    """generate fake account number"""
-    letter = chr(random.randint(65, 90))
-    AccountNumber = letter+str(random.randint(100000000,9999999999))
-    return AccountNumber
+def generate_account_number(identifier=None):
+    """generate a non-overlapping fake account number"""
+    letter, number = divmod(draw("account", identifier), 9900000000)
+    return chr(65 + letter) + str(100000000 + number)
 
 # Function to generate a random address
-def generate_random_address(state):
+def generate_random_address(state, identifier=None):
+    if is_keyed(identifier):
+        return keyed_address(state, identifier)
     street_number = random.randint(100, 9999)  # House/building number
     street = f"{random.choice(street_names)} {random.choice(street_types)}"
     city = random.choice(cities)
@@ -143,3 +323,107 @@ def generate_random_address(state):
     zip_code = random.choice(zip_codes)
 
     return f"{street_number} {street}, {city}, {county}, {precinct}, {state} ,{zip_code}"
+
+def keyed_address(state, identifier):
+    """generate_random_address with every part taken from the keyed value of identifier"""
+    value = keyed_value("address", identifier)
+    value, street_number = divmod(value, 9900)
+    value, street_name = divmod(value, len(street_names))
+    value, street_type = divmod(value, len(street_types))
+    value, city = divmod(value, len(cities))
+    value, county = divmod(value, len(counties))
+    value, precinct = divmod(value, len(precincts))
+    # zip_codes is drawn at import, so it differs between processes
+    zip_code = 10000 + value % 90000
+    return (f"{street_number + 100} {street_names[street_name]} {street_types[street_type]}, {cities[city]}, "
+            f"{counties[county]} County, {precincts[precinct]} Precinct, {state} ,{zip_code}")
+
+def generate_identity(birthdate, state, identifier=None):
+    """Complete fake identity of one patient (keyed by identifier in keyed mode)"""
+    lname, fname = generate_unique_fake_name(identifier)
+    return {
+        "fake_mrn": generate_MRN(identifier),
+        "fake_first_name": fname,
+        "fake_last_name": lname,
+        "fake_birthdate": generate_fake_birthday(birthdate, identifier),
+        "fake_hphone": generate_phone_number(identifier and (identifier, "home")),
+        "fake_bphone": generate_phone_number(identifier and (identifier, "business")),
+        "fake_SSN": generate_SSN(identifier),
+        "fake_AcctN": generate_account_number(identifier),
+        "fake_Address": generate_random_address(state, identifier),
+    }
+
+def fake_years(birthdates):
+    """Year kept by generate_fake_birthday for each birthdate ('1935' from age 90)"""
+    years = []
+    for birthdate in birthdates:
+        year = birthdate[:4]
+        if calculate_age(int(birthdate[:4]), int(birthdate[4:6]), int(birthdate[6:8])) >= 90:
+            year = "1935"
+        years.append(year)
+    return years
+
+def generate_identities(birthdates, states, identifiers=None):
+    """
+    generate_identity for many patients at once. Every sequence is advanced
+    once for the whole batch with a vectorized permutation, and the random
+    parts come from NumPy arrays, so the cost per record is mostly string
+    formatting. Without NumPy or in keyed mode, records are generated one
+    at a time.
+    """
+    count = len(birthdates)
+    if identifiers is None:
+        identifiers = [None] * count
+    if np is None or pseudonym_key is not None or count == 0:
+        return [generate_identity(birthdate, state, identifier)
+                for birthdate, state, identifier in zip(birthdates, states, identifiers)]
+    rng = np.random.default_rng(random.getrandbits(64))
+
+    last_index, first_index = np.divmod(sequence("name").take(count), len(first_names))
+    letters, numbers = np.divmod(sequence("mrn").take(count), 9999000)
+    mrns = [chr(65 + letter) + str(1000 + number) for letter, number in zip(letters.tolist(), numbers.tolist())]
+    index, lines = np.divmod(sequence("phone").take(2 * count), 9000)
+    areas, exchanges = np.divmod(index, 900)
+    phones = [f"{area + 100}-{exchange + 100}-{line + 1000}"
+              for area, exchange, line in zip(areas.tolist(), exchanges.tolist(), lines.tolist())]
+    index, serials = np.divmod(sequence("ssn").take(count), 9000)
+    areas, groups = np.divmod(index, 90)
+    ssns = [f"{area + 100}-{group + 10}-{serial + 1000}"
+            for area, group, serial in zip(areas.tolist(), groups.tolist(), serials.tolist())]
+    letters, numbers = np.divmod(sequence("account").take(count), 9900000000)
+    accounts = [chr(65 + letter) + str(100000000 + number) for letter, number in zip(letters.tolist(), numbers.tolist())]
+
+    # Birthdays: kept year, random month and day (generate_fake_birthday's rule for empty ones)
+    years = fake_years([birthdate for birthdate in birthdates if birthdate != ""])
+    month_days = (rng.integers(1, 13, count) * 100 + rng.integers(1, 29, count)).tolist()
+    kept_years = iter(years)
+    fake_birthdates = [generate_fake_birthday("") if birthdate == "" else f"{next(kept_years)}{month_day:04}"
+                       for birthdate, month_day in zip(birthdates, month_days)]
+
+    streets = zip(
+        rng.integers(100, 10000, count).tolist(),
+        rng.integers(0, len(street_names), count).tolist(),
+        rng.integers(0, len(street_types), count).tolist(),
+        rng.integers(0, len(cities), count).tolist(),
+        rng.integers(0, len(counties), count).tolist(),
+        rng.integers(0, len(precincts), count).tolist(),
+        rng.integers(0, len(zip_codes), count).tolist(),
+    )
+    addresses = [f"{number} {street_names[name]} {street_types[kind]}, {cities[city]}, {counties[county]} County, "
+                 f"{precincts[precinct]} Precinct, {state} ,{zip_codes[zip_code]}"
+                 for (number, name, kind, city, county, precinct, zip_code), state in zip(streets, states)]
+
+    return [
+        {
+            "fake_mrn": mrns[i],
+            "fake_first_name": first_names[first],
+            "fake_last_name": last_names[last],
+            "fake_birthdate": fake_birthdates[i],
+            "fake_hphone": phones[2 * i],
+            "fake_bphone": phones[2 * i + 1],
+            "fake_SSN": ssns[i],
+            "fake_AcctN": accounts[i],
+            "fake_Address": addresses[i],
+        }
+        for i, (last, first) in enumerate(zip(last_index.tolist(), first_index.tolist()))
+    ]
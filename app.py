@@ -1,361 +1,227 @@
 import streamlit as st
-import hl7
+import hl7_tokenizer
+import message_diff
+import message_index
+import message_render
+import metrics
 import pandas as pd
+import search_index
+import numpy as np
 import math
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Input files of the viewer. The source map written by dict_creator pairs
+# each fixed message with the span of its raw message; without one, the
+# files are paired by position.
+FIXED_FILE = "messages_deidentified.txt"
+SOURCE_MAP_FILE = FIXED_FILE + message_index.SOURCE_MAP_SUFFIX
+RAW_FILE = "raw.txt"
+
+# Metrics file named by BEARDOWN_METRICS (None: metrics off); rewritten
+# after every rerun with the totals of this server process
+METRICS_FILE = metrics.configure_from_env()
+
+# Search box column -> lowercased categorical column used for filtering
+SEARCH_KEYS = {
+    "Message Control ID": "message_id_key",
+    "MRN": "mrn_key",
+    "Last Name": "last_name_key",
+}
+
+# (path, size, mtime) of a file; any change invalidates the cached table
+def file_signature(path):
+    stat = os.stat(path)
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+# Raw file the fixed messages were made from: the source named in the source map, if any
+def raw_file_path():
+    if os.path.exists(SOURCE_MAP_FILE):
+        return message_index.read_source_path(SOURCE_MAP_FILE)
+    return RAW_FILE
+
+# Signatures of the fixed file, its source map (None without one) and the raw file
+def feed_signatures():
+    source_map_signature = file_signature(SOURCE_MAP_FILE) if os.path.exists(SOURCE_MAP_FILE) else None
+    return file_signature(FIXED_FILE), source_map_signature, file_signature(raw_file_path())
+
+# Memory-mapped offset indexes of both files (kept in a sidecar per file) and
+# the source map. Message bodies are read on demand and never held in the table.
+@st.cache_resource(max_entries=2, show_spinner=False)
+def open_feed(fixed_signature, source_map_signature, raw_signature):
+    source_map = message_index.SourceMap(source_map_signature[0]) if source_map_signature else None
+    return (message_index.MessageIndex(fixed_signature[0], persist=True),
+            message_index.MessageIndex(raw_signature[0], persist=True),
+            source_map)
+
+# Raw span of fixed message idx: from the source map when there is one, by
+# position otherwise. (-1, 0) marks a missing raw message.
+def raw_span(idx, raw_index, source_map):
+    if source_map is None:
+        return raw_index.span(idx) if idx < len(raw_index) else (-1, 0)
+    if idx >= len(source_map):
+        return -1, 0
+    offset, length = source_map.span(idx)
+    return (offset, length) if offset + length <= raw_index.size else (-1, 0)
+
+# Parses both files into the summary table: identifying fields plus the byte
+# span of each message. Runs in a background thread, so warnings are
+# returned instead of written with st.warning.
+@metrics.timed("viewer_table_build")
+def build_message_table(fixed_index, raw_index, source_map):
+    warnings = []
+
+    # Validate message counts
+    if source_map is None:
+        if len(fixed_index) != len(raw_index):
+            warnings.append(f"Warning: Number of messages in {FIXED_FILE} ({len(fixed_index)}) does not match {raw_index.path} ({len(raw_index)}) and there is no {SOURCE_MAP_FILE}. Some messages may be misaligned.")
+    elif len(fixed_index) != len(source_map):
+        warnings.append(f"Warning: {SOURCE_MAP_FILE} has {len(source_map)} entries for {len(fixed_index)} messages in {FIXED_FILE}. It may be stale; re-run dict_creator.")
+
+    parsed_messages = []
+    mismatched_ids = 0
+    for idx in range(len(fixed_index)):
+        message = fixed_index[idx]
+        fixed_offset, fixed_length = fixed_index.span(idx)
+        raw_offset, raw_length = raw_span(idx, raw_index, source_map)
+        if source_map is not None and idx < len(source_map) and \
+                hl7_tokenizer.header_field(message, 10) != source_map.control_ids[idx]:
+            mismatched_ids += 1
+        spans = {
+            "Fixed Offset": fixed_offset,
+            "Fixed Length": fixed_length,
+            "Raw Offset": raw_offset,
+            "Raw Length": raw_length,
+        }
+
+        try:
+            # Only the MSH and PID segments are split into fields
+            h = hl7_tokenizer.parse(message)
+            MessageID = "N/A"
+            mrn = "N/A"
+            lname = "N/A"
+            fname = "N/A"
+            birthdate = "N/A"
+
+            segment = h.segment('MSH')
+            if segment is not None:
+                # Message Control ID is usually in MSH-10
+                MessageID = segment[10].strip() if len(segment) > 10 else "N/A"
+
+            segment = h.segment('PID')
+            if segment is not None:
+                # MRN is usually in PID-3
+                mrn = segment[3].strip() if len(segment) > 3 else "N/A"
+
+                # Patient name is usually in PID-5
+                if len(segment) > 5:
+                    name_parts = segment.components(5)
+                    lname = name_parts[0] if len(name_parts) > 0 else "N/A"
+                    fname = name_parts[1] if len(name_parts) > 1 else "N/A"
+
+                # Birthdate is usually in PID-7
+                birthdate = segment[7].strip() if len(segment) > 7 else "N/A"
+
+            parsed_messages.append({
+                "Message Control ID": MessageID,
+                "MRN": mrn,
+                "Last Name": lname,
+                "First Name": fname,
+                "Birthdate": birthdate,
+                **spans
+            })
+        except Exception as e:
+            metrics.count("unparseable_messages")
+            warnings.append(f"Warning: Failed to parse message {idx+1}: {str(e)}")
+            # Still add the message with error indicators
+            parsed_messages.append({
+                "Message Control ID": f"ERROR-{idx}",
+                "MRN": "ERROR",
+                "Last Name": "ERROR",
+                "First Name": "ERROR",
+                "Birthdate": "ERROR",
+                **spans
+            })
+
+    if mismatched_ids:
+        warnings.append(f"Warning: {mismatched_ids} messages do not match the control ID recorded in {SOURCE_MAP_FILE}. It may be stale; re-run dict_creator.")
+
+    df = pd.DataFrame(parsed_messages)
+    if df.empty:
+        return df, None, warnings
+    # Each distinct value is lowercased and stored once, and indexed once
+    for column, key in SEARCH_KEYS.items():
+        df[key] = df[column].str.lower().astype("category")
+    # The word index of the bodies is built separately, on the first text search
+    index = search_index.MessageSearchIndex(df, SEARCH_KEYS)
+    return df, index, warnings
+
+# The table is built once per version of the input files and shared by all
+# sessions and reruns. The build runs in a background thread; sessions that
+# arrive while it runs wait on the same future instead of parsing again.
+@st.cache_resource(max_entries=2, show_spinner=False)
+def start_message_table_build(fixed_signature, source_map_signature, raw_signature):
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(build_message_table, *open_feed(fixed_signature, source_map_signature, raw_signature))
+    executor.shutdown(wait=False)
+    return future
+
+# Word index of the fixed message bodies. Its size grows with the feed, so
+# it is built only once someone searches the message text, and then shared
+# by all sessions until the files change.
+@st.cache_resource(max_entries=1, show_spinner=False)
+def text_search_index(fixed_signature, source_map_signature, raw_signature):
+    fixed_index = open_feed(fixed_signature, source_map_signature, raw_signature)[0]
+    with metrics.timer("viewer_text_index_build"):
+        return search_index.text_index(iter(fixed_index))
 
 # Function to parse HL7 messages from messages_deidentified.txt and raw.txt
 def parse_hl7_messages():
     try:
         # Check if files exist before opening
-        if not os.path.exists("messages_deidentified.txt") or not os.path.exists("raw.txt"):
-            missing_files = []
-            if not os.path.exists("messages_deidentified.txt"):
-                missing_files.append("messages_deidentified.txt")
-            if not os.path.exists("raw.txt"):
-                missing_files.append("raw.txt")
+        missing_files = [path for path in (FIXED_FILE, raw_file_path()) if not os.path.exists(path)]
+        if missing_files:
             st.error(f"Error: {', '.join(missing_files)} file(s) not found. Please place the file(s) in the same directory as this script.")
-            return pd.DataFrame()
-        
-        with open("messages_deidentified.txt", "r", encoding="utf-8") as file:
-            fixed_data = file.read()
-        with open("raw.txt", "r", encoding="utf-8") as file:
-            raw_data = file.read()
-        
-        # Split the data by MSH| markers
-        fixed_messages = [
-            "MSH|" + msg.strip().replace('\n', '\r')
-            for msg in fixed_data.split('MSH|') if msg.strip()
-        ]
-        raw_messages = [
-            "MSH|" + msg.strip().replace('\n', '\r')
-            for msg in raw_data.split('MSH|') if msg.strip()
-        ]
-        
-        # Validate message counts
-        if len(fixed_messages) != len(raw_messages):
-            st.warning(f"Warning: Number of messages in messages_deidentified.txt ({len(fixed_messages)}) does not match raw.txt ({len(raw_messages)}). Some messages may be misaligned.")
-        
-        parsed_messages = []
-        for idx, message in enumerate(fixed_messages):
-            # Ensure we don't go out of bounds
-            current_raw_message = raw_messages[idx] if idx < len(raw_messages) else "Raw message not available"
-            
-            try:
-                h = hl7.parse(message)
-                MessageID = "N/A"
-                mrn = "N/A"
-                lname = "N/A"
-                fname = "N/A"
-                birthdate = "N/A"
-                
-                for segment in h:
-                    segment_type = str(segment[0]).strip()
-                    
-                    if segment_type == 'MSH':
-                        # Message Control ID is usually in MSH-10
-                        MessageID = str(segment[10]).strip() if len(segment) > 10 else "N/A"
-                    
-                    elif segment_type == 'PID':
-                        # MRN is usually in PID-3
-                        mrn = str(segment[3]).strip() if len(segment) > 3 else "N/A"
-                        
-                        # Patient name is usually in PID-5
-                        if len(segment) > 5:
-                            name_parts = str(segment[5]).split("^")
-                            lname = name_parts[0] if len(name_parts) > 0 else "N/A"
-                            fname = name_parts[1] if len(name_parts) > 1 else "N/A"
-                        
-                        # Birthdate is usually in PID-7
-                        birthdate = str(segment[7]).strip() if len(segment) > 7 else "N/A"
-                
-                parsed_messages.append({
-                    "Message Control ID": MessageID, 
-                    "MRN": mrn, 
-                    "Last Name": lname, 
-                    "First Name": fname, 
-                    "Birthdate": birthdate, 
-                    "Fixed Message": message, 
-                    "Raw Message": current_raw_message
-                })
-            except Exception as e:
-                st.warning(f"Warning: Failed to parse message {idx+1}: {str(e)}")
-                # Still add the message with error indicators
-                parsed_messages.append({
-                    "Message Control ID": f"ERROR-{idx}", 
-                    "MRN": "ERROR", 
-                    "Last Name": "ERROR", 
-                    "First Name": "ERROR", 
-                    "Birthdate": "ERROR", 
-                    "Fixed Message": message, 
-                    "Raw Message": current_raw_message
-                })
-        
-        if not parsed_messages:
+            return pd.DataFrame(), None, None
+
+        signatures = feed_signatures()
+        future = start_message_table_build(*signatures)
+        try:
+            if future.done():
+                df, index, warnings = future.result()
+            else:
+                with st.spinner("Indexing HL7 messages..."):
+                    df, index, warnings = future.result()
+        except Exception:
+            # Do not keep a failed build cached
+            start_message_table_build.clear()
+            open_feed.clear()
+            raise
+
+        for warning in warnings:
+            st.warning(warning)
+        if df.empty:
             st.warning("No valid HL7 messages found in the input files.")
-            return pd.DataFrame()
-            
-        return pd.DataFrame(parsed_messages)
+        return df, index, signatures
     except Exception as e:
         st.error(f"Error: An unexpected error occurred: {str(e)}")
-        return pd.DataFrame()
-
-# Render the inline representation with tooltips.
-# Render the inline representation with tooltips.
-def render_line_inline(line):
-    fields = line.split("|")
-    seg_name = fields[0]
-    rendered_fields = []
-    rendered_fields.append(
-        f'<span title="{seg_name}-00" style="border:1px solid #ccc; padding:2px 4px; margin:2px; display:inline-block;">{seg_name}</span>'
-    )
-    
-    # Special handling for MSH segment
-    if seg_name == "MSH":
-        # For MSH, the first pipe is actually MSH-01
-        rendered_fields.append(
-            f'<span title="MSH-01" style="border:1px solid #ccc; padding:2px 4px; margin:2px; display:inline-block;">|</span>'
-        )
-        # Start indexing from 2 for remaining fields in MSH
-        start_idx = 2
-        
-        # Process first field (index 1 in the original fields array) without a leading pipe
-        if len(fields) > 1:
-            field = fields[1]
-            field_label = f"{seg_name}-{start_idx:02d}"
-            if "^" in field and field != "^~\&":
-                subfields = field.split("^")
-                rendered_subfields = []
-                for sub_idx, sub in enumerate(subfields, start=1):
-                    sub_label = f"{field_label}.{sub_idx}"
-                    rendered_subfields.append(
-                        f'<span title="{sub_label}" style="border:1px dashed #aaa; padding:2px 4px; margin:2px; display:inline-block;">{sub}</span>'
-                    )
-                field_html = " ^ ".join(rendered_subfields)
-            else:
-                field_html = f'<span title="{field_label}" style="border:1px solid #ccc; padding:2px 4px; margin:2px; display:inline-block;">{field}</span>'
-            rendered_fields.append(field_html)
-            
-            # Process remaining fields (index 2+ in the original fields array) with leading pipes
-            for idx, field in enumerate(fields[2:], start=start_idx+1):
-                field_label = f"{seg_name}-{idx:02d}"
-                if "^" in field and field != "^~\&":
-                    subfields = field.split("^")
-                    rendered_subfields = []
-                    for sub_idx, sub in enumerate(subfields, start=1):
-                        sub_label = f"{field_label}.{sub_idx}"
-                        rendered_subfields.append(
-                            f'<span title="{sub_label}" style="border:1px dashed #aaa; padding:2px 4px; margin:2px; display:inline-block;">{sub}</span>'
-                        )
-                    field_html = " ^ ".join(rendered_subfields)
-                else:
-                    field_html = f'<span title="{field_label}" style="border:1px solid #ccc; padding:2px 4px; margin:2px; display:inline-block;">{field}</span>'
-                rendered_fields.append(" | " + field_html)
-        
-        return "".join(rendered_fields)
-    else:
-        # Normal handling for non-MSH segments
-        for idx, field in enumerate(fields[1:], start=1):
-            field_label = f"{seg_name}-{idx:02d}"
-            if "^" in field and field != "^~\&":
-                subfields = field.split("^")
-                rendered_subfields = []
-                for sub_idx, sub in enumerate(subfields, start=1):
-                    sub_label = f"{field_label}.{sub_idx}"
-                    rendered_subfields.append(
-                        f'<span title="{sub_label}" style="border:1px dashed #aaa; padding:2px 4px; margin:2px; display:inline-block;">{sub}</span>'
-                    )
-                field_html = " ^ ".join(rendered_subfields)
-            else:
-                field_html = f'<span title="{field_label}" style="border:1px solid #ccc; padding:2px 4px; margin:2px; display:inline-block;">{field}</span>'
-            rendered_fields.append(field_html)
-        
-        return " | ".join(rendered_fields)
-
-# Build a two-column table (HTML) for the dropdown details.
-def render_field_details_table(line):
-    fields = line.split("|")
-    seg_name = fields[0]
-    rows = []
-    rows.append(
-        f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{seg_name}-00</strong></td>"
-        f"<td style='padding:2px 4px; border:1px solid #555;'>{fields[0]}</td></tr>"
-    )
-    
-    # Special handling for MSH segment
-    if seg_name == "MSH":
-        # Add MSH-01 row for the pipe character
-        rows.append(
-            f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>MSH-01</strong></td>"
-            f"<td style='padding:2px 4px; border:1px solid #555;'>|</td></tr>"
-        )
-        # Start indexing from 2 for remaining fields in MSH
-        start_idx = 2
-    else:
-        start_idx = 1
-    
-    for idx, field in enumerate(fields[1:], start=start_idx):
-        field_label = f"{seg_name}-{idx:02d}"
-        if "^" not in field:
-            rows.append(
-                f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{field_label}</strong></td>"
-                f"<td style='padding:2px 4px; border:1px solid #555;'>{field}</td></tr>"
-            )
-        else:
-            subfields = field.split("^")
-            rows.append(
-                f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{field_label}</strong></td>"
-                f"<td style='padding:2px 4px; border:1px solid #555;'></td></tr>"
-            )
-            for sub_idx, sub in enumerate(subfields, start=1):
-                rows.append(
-                    f"<tr><td style='padding:2px 4px; border:1px solid #555; padding-left:16px;'><em>{field_label}.{sub_idx}</em></td>"
-                    f"<td style='padding:2px 4px; border:1px solid #555; padding-left:16px;'>{sub}</td></tr>"
-                )
-    table_html = (
-        "<table style='width:100%; border-collapse:collapse; font-size:0.9em;'>"
-        + "".join(rows)
-        + "</table>"
-    )
-    return table_html
-
-# Build a two-column table (HTML) for the dropdown details.
-def render_field_details_table(line):
-    fields = line.split("|")
-    seg_name = fields[0]
-    rows = []
-    rows.append(
-        f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{seg_name}-00</strong></td>"
-        f"<td style='padding:2px 4px; border:1px solid #555;'>{fields[0]}</td></tr>"
-    )
-    
-    # Special handling for MSH segment
-    if seg_name == "MSH":
-        # Add MSH-01 row for the pipe character
-        rows.append(
-            f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>MSH-01</strong></td>"
-            f"<td style='padding:2px 4px; border:1px solid #555;'>|</td></tr>"
-        )
-        # Start indexing from 2 for remaining fields in MSH
-        start_idx = 2
-    else:
-        start_idx = 1
-    
-    for idx, field in enumerate(fields[1:], start=start_idx):
-        field_label = f"{seg_name}-{idx:02d}"
-        if "^" not in field:
-            rows.append(
-                f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{field_label}</strong></td>"
-                f"<td style='padding:2px 4px; border:1px solid #555;'>{field}</td></tr>"
-            )
-        else:
-            subfields = field.split("^")
-            rows.append(
-                f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{field_label}</strong></td>"
-                f"<td style='padding:2px 4px; border:1px solid #555;'></td></tr>"
-            )
-            for sub_idx, sub in enumerate(subfields, start=1):
-                rows.append(
-                    f"<tr><td style='padding:2px 4px; border:1px solid #555; padding-left:16px;'><em>{field_label}.{sub_idx}</em></td>"
-                    f"<td style='padding:2px 4px; border:1px solid #555; padding-left:16px;'>{sub}</td></tr>"
-                )
-    table_html = (
-        "<table style='width:100%; border-collapse:collapse; font-size:0.9em;'>"
-        + "".join(rows)
-        + "</table>"
-    )
-    return table_html
-# Build a two-column table (HTML) for the dropdown details.
-def render_field_details_table(line):
-    fields = line.split("|")
-    seg_name = fields[0]
-    rows = []
-    rows.append(
-        f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{seg_name}-00</strong></td>"
-        f"<td style='padding:2px 4px; border:1px solid #555;'>{fields[0]}</td></tr>"
-    )
-    
-    # Special handling for MSH segment
-    if seg_name == "MSH":
-        # Add MSH-01 row for the pipe character
-        rows.append(
-            f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>MSH-01</strong></td>"
-            f"<td style='padding:2px 4px; border:1px solid #555;'>|</td></tr>"
-        )
-        # Start indexing from 2 for remaining fields in MSH
-        start_idx = 2
-    else:
-        start_idx = 1
-    
-    for idx, field in enumerate(fields[1:], start=start_idx):
-        field_label = f"{seg_name}-{idx:02d}"
-        if "^" not in field:
-            rows.append(
-                f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{field_label}</strong></td>"
-                f"<td style='padding:2px 4px; border:1px solid #555;'>{field}</td></tr>"
-            )
-        else:
-            subfields = field.split("^")
-            rows.append(
-                f"<tr><td style='padding:2px 4px; border:1px solid #555;'><strong>{field_label}</strong></td>"
-                f"<td style='padding:2px 4px; border:1px solid #555;'></td></tr>"
-            )
-            for sub_idx, sub in enumerate(subfields, start=1):
-                rows.append(
-                    f"<tr><td style='padding:2px 4px; border:1px solid #555; padding-left:16px;'><em>{field_label}.{sub_idx}</em></td>"
-                    f"<td style='padding:2px 4px; border:1px solid #555; padding-left:16px;'>{sub}</td></tr>"
-                )
-    table_html = (
-        "<table style='width:100%; border-collapse:collapse; font-size:0.9em;'>"
-        + "".join(rows)
-        + "</table>"
-    )
-    return table_html
-
-# Render a full HTML box for one HL7 segment line.
-def render_line_with_dropdown(line):
-    if not line or "|" not in line:
-        return f"<div style='background-color:#faa; padding:4px 8px; margin:4px 0; border-radius:4px;'>Invalid segment: {line}</div>"
-    
-    seg_name = line.split("|")[0]
-    inline_html = render_line_inline(line)
-    details_table = render_field_details_table(line)
-    
-    # Color-code different segment types
-    bg_color = "#333"  # default
-    if seg_name == "MSH":
-        bg_color = "#225"  # darker blue for header
-    elif seg_name == "PID":
-        bg_color = "#252"  # green for patient info
-    elif seg_name == "OBR":
-        bg_color = "#522"  # red for orders
-    elif seg_name == "OBX":
-        bg_color = "#552"  # yellow-ish for observations
-    
-    # The container is compact. The details element is now inline so when opened, it pushes the box to expand.
-    html = f"""<div style="background-color:{bg_color}; padding:4px 8px; margin:4px 0; border-radius:4px; color:white; font-family:Arial, sans-serif; line-height:1.2em;">
-  <div style="font-weight:bold; font-size:1.1em;">{seg_name}</div>
-  <div style="margin-top:2px;">{inline_html}</div>
-  <div style="text-align:right; margin-top:2px;">
-    <details style="color:white; display:inline-block;">
-      <summary style="cursor:pointer; font-size:0.9em; margin:0;">Details</summary>
-      <div style="margin-top:2px;">{details_table}</div>
-    </details>
-  </div>
-</div>"""
-    return html
-
-# Display each line of the message (Fixed or Raw) as its own compact box.
+        return pd.DataFrame(), None, None
+
+# Fixed and raw text of one table row, read from disk by byte span
+def load_messages(feed, row):
+    fixed_index, raw_index, _ = feed
+    fixed_message = fixed_index.text_at(row["Fixed Offset"], row["Fixed Length"])
+    if row["Raw Offset"] < 0:
+        return fixed_message, "Raw message not available"
+    return fixed_message, raw_index.text_at(row["Raw Offset"], row["Raw Length"])
+
+# Display the message (Fixed or Raw) with one compact box per line, rendered in a single call.
 def display_message_details(message_text):
     if not message_text or message_text == "Raw message not available":
         st.info("No message data available")
         return
-        
-    lines = message_text.replace('\r', '\n').split("\n")
-    for line in lines:
-        if line.strip():
-            box_html = render_line_with_dropdown(line)
-            st.markdown(box_html, unsafe_allow_html=True)
+
+    st.markdown(message_render.render_message(message_text), unsafe_allow_html=True)
 
 # Function to display differences between fixed and raw messages
 def display_message_diff(fixed_message, raw_message):
@@ -364,24 +230,69 @@ def display_message_diff(fixed_message, raw_message):
     if fixed_message == "Raw message not available" or raw_message == "Raw message not available":
         st.warning("Cannot compare messages - one or both messages are not available")
         return
-        
-    fixed_lines = fixed_message.replace('\r', '\n').split("\n")
-    raw_lines = raw_message.replace('\r', '\n').split("\n")
-    
-    # Create side-by-side columns
-    col1, col2 = st.columns(2)
-    
-    with col1:
-        st.write("#### Fixed Message")
-        for line in fixed_lines:
-            if line.strip():
-                st.code(line, language=None)
-    
-    with col2:
-        st.write("#### Raw Message")
-        for line in raw_lines:
-            if line.strip():
-                st.code(line, language=None)
+
+    # Segments are aligned by type and set-ID; only the changed fields and components are listed
+    diffs = message_diff.diff_messages(fixed_message, raw_message)
+    changes = []
+    for diff in diffs:
+        segment = message_diff.key_label(diff.key)
+        if diff.fixed is None:
+            changes.append({"Segment": segment, "Field": "(removed)", "Raw": diff.raw.text, "Fixed": ""})
+        elif diff.raw is None:
+            changes.append({"Segment": segment, "Field": "(added)", "Raw": "", "Fixed": diff.fixed.text})
+        for change in diff.changes:
+            changes.append({"Segment": segment, "Field": change.label, "Raw": change.raw, "Fixed": change.fixed})
+    unchanged = sum(1 for diff in diffs if diff.raw is not None and diff.fixed is not None and not diff.changes)
+    st.write(f"{len(changes)} changes, {unchanged} of {len(diffs)} segments unchanged")
+    if changes:
+        st.dataframe(pd.DataFrame(changes), use_container_width=True, hide_index=True)
+
+    with st.expander("Side by side"):
+        fixed_lines = fixed_message.replace('\r', '\n').split("\n")
+        raw_lines = raw_message.replace('\r', '\n').split("\n")
+
+        # Create side-by-side columns
+        col1, col2 = st.columns(2)
+
+        with col1:
+            st.write("#### Fixed Message")
+            for line in fixed_lines:
+                if line.strip():
+                    st.code(line, language=None)
+
+        with col2:
+            st.write("#### Raw Message")
+            for line in raw_lines:
+                if line.strip():
+                    st.code(line, language=None)
+
+# Field change rates over the whole feed, computed once per version of the files
+@st.cache_resource(max_entries=2, show_spinner=False)
+def feed_change_summary(fixed_signature, source_map_signature, raw_signature):
+    fixed_index, raw_index, _ = open_feed(fixed_signature, source_map_signature, raw_signature)
+    df = start_message_table_build(fixed_signature, source_map_signature, raw_signature).result()[0]
+    paired = df[df["Raw Offset"] >= 0]
+    return message_diff.summarize_changes(
+        (fixed_index.text_at(fixed_offset, fixed_length), raw_index.text_at(raw_offset, raw_length))
+        for fixed_offset, fixed_length, raw_offset, raw_length in
+        zip(paired["Fixed Offset"], paired["Fixed Length"], paired["Raw Offset"], paired["Raw Length"]))
+
+# Function to display which fields de-identification changed across the feed
+def display_feed_summary(signatures):
+    with st.expander("Feed Change Summary"):
+        if not st.checkbox("Summarize changes across all messages"):
+            return
+        with st.spinner("Comparing all messages..."):
+            messages, summary = feed_change_summary(*signatures)
+        rows = [{
+            "Field": label,
+            "Messages Changed": changed,
+            "Messages With Segment": present,
+            "% Changed": round(100 * changed / present, 1) if present else 0.0,
+        } for label, (changed, present) in summary.items()]
+        st.write(f"{messages} messages compared, {len(rows)} fields changed")
+        if rows:
+            st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
 
 # --- Streamlit UI ---
 def main():
@@ -393,9 +304,10 @@ def main():
     items_per_page = 50
     
     # Process data
-    df = parse_hl7_messages()
+    df, index, signatures = parse_hl7_messages()
 
     if not df.empty:
+        feed = open_feed(*signatures)
         st.write("### HL7 Messages")
         
         # Create 3 columns for search inputs
@@ -406,18 +318,24 @@ def main():
             search_mrn = st.text_input("Search by MRN")
         with col3:
             search_name = st.text_input("Search by Last Name")
+        search_text = st.text_input("Search message text", help="Messages containing every word (or part of a word) entered")
 
-        # Apply filters
-        filtered_df = df.copy()
-        if search_MessageID:
-            filtered_df = filtered_df[filtered_df["Message Control ID"].str.contains(search_MessageID, case=False, na=False)]
-        if search_mrn:
-            filtered_df = filtered_df[filtered_df["MRN"].str.contains(search_mrn, case=False, na=False)]
-        if search_name:
-            filtered_df = filtered_df[filtered_df["Last Name"].str.contains(search_name, case=False, na=False)]
+        # Look up the matching row ids in the search index; the cached table itself is never copied
+        text_index = None
+        if search_text.strip():
+            with st.spinner("Indexing message text..."):
+                text_index = text_search_index(*signatures)
+        with metrics.timer("viewer_search"):
+            filtered_rows = index.search({
+                "Message Control ID": search_MessageID,
+                "MRN": search_mrn,
+                "Last Name": search_name,
+            }, search_text, text_index)
+        if filtered_rows is None:
+            filtered_rows = np.arange(len(df))
 
         # Pagination
-        total_items = filtered_df.shape[0]
+        total_items = len(filtered_rows)
         total_pages = math.ceil(total_items / items_per_page) if total_items > 0 else 1
 
         # Initialize page state
@@ -446,44 +364,55 @@ def main():
         # Calculate slice for current page
         start_idx = st.session_state.page * items_per_page
         end_idx = start_idx + items_per_page
-        current_page_df = filtered_df.iloc[start_idx:end_idx]
+        current_page_df = df.iloc[filtered_rows[start_idx:end_idx]]
+
+        # Display dataframe with all columns including the fixed message; only this page's bodies are read
+        display_cols = ["Message Control ID", "MRN", "Last Name", "First Name", "Birthdate"]
+        with metrics.timer("viewer_render_page"):
+            page_messages = [feed[0].text_at(offset, length) for offset, length in
+                             zip(current_page_df["Fixed Offset"], current_page_df["Fixed Length"])]
+            st.dataframe(current_page_df[display_cols].assign(**{"Fixed Message": page_messages}), use_container_width=True)
 
-        # Display dataframe with all columns including the fixed message
-        display_cols = ["Message Control ID", "MRN", "Last Name", "First Name", "Birthdate", "Fixed Message"]
-        st.dataframe(current_page_df[display_cols], use_container_width=True)
+        display_feed_summary(signatures)
 
         # Message selection - moved above the output section but below the main table
         if not current_page_df.empty:
             # Select message
             selected_index = st.selectbox("Select a message to view details", 
                                         current_page_df.index,
-                                        format_func=lambda x: f"{filtered_df.loc[x, 'Message Control ID']} - {filtered_df.loc[x, 'Last Name']}, {filtered_df.loc[x, 'First Name']}")
+                                        format_func=lambda x: f"{df.loc[x, 'Message Control ID']} - {df.loc[x, 'Last Name']}, {df.loc[x, 'First Name']}")
             
+            fixed_message, raw_message = load_messages(feed, df.loc[selected_index])
+
             # Tabs for different views
             tab1, tab2, tab3 = st.tabs(["Message Details", "Message Comparison", "Raw Data"])
             
             with tab1:
                 # Details view
                 st.write(f"### Fixed Message Details")
-                display_message_details(filtered_df.loc[selected_index, "Fixed Message"])
+                display_message_details(fixed_message)
                 st.write(f"### Raw Message Details")
-                display_message_details(filtered_df.loc[selected_index, "Raw Message"])
+                display_message_details(raw_message)
             
             with tab2:
                 # Comparison view
                 display_message_diff(
-                    filtered_df.loc[selected_index, "Fixed Message"],
-                    filtered_df.loc[selected_index, "Raw Message"]
+                    fixed_message,
+                    raw_message
                 )
             
             with tab3:
                 # Raw Data view
                 st.write("### Fixed Message (Raw Text)")
-                st.text_area("Fixed Message", filtered_df.loc[selected_index, "Fixed Message"], height=200)
+                st.text_area("Fixed Message", fixed_message, height=200)
                 st.write("### Raw Message (Raw Text)")
-                st.text_area("Raw Message", filtered_df.loc[selected_index, "Raw Message"], height=200)
+                st.text_area("Raw Message", raw_message, height=200)
     else:
         st.info("No messages to display. Please check your HL7 files (messages_deidentified.txt and raw.txt).")
 
+    if METRICS_FILE:
+        metrics.count("viewer_reruns")
+        metrics.dump(METRICS_FILE)
+
 if __name__ == "__main__":
     main()
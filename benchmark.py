@@ -0,0 +1,668 @@
+import argparse
+import contextlib
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import RandomGenerator as RG
+import hl7_tokenizer
+
+# dict_creator is a script without a .py extension, so it is loaded by path
+def load_dict_creator():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dict_creator")
+    loader = importlib.machinery.SourceFileLoader("dict_creator", path)
+    spec = importlib.util.spec_from_loader("dict_creator", loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["dict_creator"] = module  # lets worker processes unpickle its functions
+    loader.exec_module(module)
+    return module
+
+def make_patient(i):
+    """Builds a synthetic patient record as produced by extract_patient_data"""
+    return {
+        "mrn": f"W{i:09d}",
+        "first_name": random.choice(RG.first_names).lower(),
+        "last_name": random.choice(RG.last_names).lower() + str(i),
+        "birthdate": f"19{random.randint(30, 99)}{random.randint(1, 12):02}{random.randint(1, 28):02}",
+        "SSN": f"{i // 1000000:03}-{i // 10000 % 100:02}-{i % 10000:04}",
+    }
+
+# Per-lookup cost of find_matching_patient as the patient table grows
+def bench_patient_index(sizes, lookups):
+    dc = load_dict_creator()
+    patient_dict = {}
+    patient_index = dc.build_patient_index(patient_dict)
+    print(f"{'patients':>10} {'lookup us':>10} {'hit rate':>9}")
+    for size in sizes:
+        for i in range(len(patient_dict), size):
+            patient_data = make_patient(i)
+            patient_dict[patient_data["mrn"]] = patient_data
+            dc.index_patient(patient_index, patient_data["mrn"], patient_data)
+
+        # Half of the queries hit an existing patient, half are new patients
+        queries = []
+        for _ in range(lookups):
+            if random.random() < 0.5:
+                queries.append(dict(patient_dict[f"W{random.randrange(size):09d}"]))
+            else:
+                queries.append(make_patient(size + random.randrange(size)))
+
+        hits = 0
+        start = time.perf_counter()
+        for query in queries:
+            if dc.find_matching_patient(query, patient_dict, patient_index) is not None:
+                hits += 1
+        elapsed = time.perf_counter() - start
+        print(f"{size:>10} {elapsed / lookups * 1e6:>10.2f} {hits / lookups:>9.2f}")
+
+def write_sample_feed(path, copies):
+    """Writes messages_sorted.txt repeated copies times to path"""
+    sample_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "messages_sorted.txt")
+    with open(sample_path, encoding="utf-8") as file:
+        sample = file.read().rstrip("\n") + "\n"
+    with open(path, "w", encoding="utf-8") as file:
+        for _ in range(copies):
+            file.write(sample)
+
+# Serial vs. process pool compile on a scaled-up sample feed
+def bench_compile(copies, workers_list):
+    dc = load_dict_creator()
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = os.path.join(tmp, "raw.txt")
+        write_sample_feed(feed, copies)
+        cwd = os.getcwd()
+        os.chdir(tmp)  # extract_unique_patients writes result.json to the working directory
+        try:
+            patient_dict, message_map = dc.extract_unique_patients(feed, os.path.join(tmp, "output.txt"))
+        finally:
+            os.chdir(cwd)
+        print(f"{len(message_map)} messages, {len(patient_dict)} patients")
+        print(f"{'workers':>8} {'seconds':>8} {'msg/s':>9} {'speedup':>8}")
+        baseline = None
+        reference = None
+        for workers in workers_list:
+            output = os.path.join(tmp, f"out_{workers}.txt")
+            # Same doctor pseudonyms for every run
+            state = RG.snapshot_state()
+            start = time.perf_counter()
+            dc.compile(feed, patient_dict, message_map, output, workers=workers)
+            elapsed = time.perf_counter() - start
+            RG.restore_state(state)
+            baseline = baseline or elapsed
+            with open(output, "rb") as file:
+                data = file.read()
+            reference = reference or data
+            print(f"{workers:>8} {elapsed:>8.2f} {len(message_map) / elapsed:>9.0f} {baseline / elapsed:>7.2f}x")
+            assert data == reference, f"compile with {workers} workers differs from {workers_list[0]} worker(s)"
+
+def make_obx_nte_message(patient_data, segments):
+    """Builds an OBX/NTE-heavy message mentioning the patient in free text"""
+    name = f"{patient_data['first_name']} {patient_data['last_name']}"
+    year, month, day = patient_data["birthdate"][:4], patient_data["birthdate"][4:6], patient_data["birthdate"][6:]
+    texts = [
+        f"Scheduling MRI for {name} to evaluate chronic headaches.",
+        f"Patient {name}, DOB {month}/{day}/{year}, reports dizziness since 03/14/2024.",
+        "Blood pressure stable, follow up in 2 weeks.",
+        f"ID {patient_data['SSN']} verified, birthdate May {int(day)}, {year}.",
+        "Heart rate 72 BPM, temperature 98.6 F.",
+    ]
+    lines = []
+    for i in range(segments):
+        if i % 2:
+            lines.append(f"NTE|{i}||{texts[i % len(texts)]}")
+        else:
+            lines.append(f"OBX|{i}|TX|SS12345||{texts[i % len(texts)]}")
+    return lines
+
+# Non-PID segment sanitizer on OBX/NTE-heavy messages
+def bench_sanitize(patients, segments):
+    dc = load_dict_creator()
+    workload = []
+    for i in range(patients):
+        patient_data = make_patient(i)
+        patient_data.update({"AcctN": f"A{i:09d}", "hphone": "615-344-9551", "bphone": ""})
+        workload.append((patient_data, make_obx_nte_message(patient_data, segments)))
+
+    start = time.perf_counter()
+    redacted = 0
+    for patient_data, lines in workload:
+        for line in lines:
+            if dc.sanitize_non_pid_segment(line, patient_data) != line:
+                redacted += 1
+    elapsed = time.perf_counter() - start
+    total = patients * segments
+    print(f"{total} segments ({patients} patients x {segments} OBX/NTE), {redacted} redacted")
+    print(f"{elapsed:.2f} s, {total / elapsed:.0f} segments/s, {elapsed / total * 1e6:.1f} us/segment")
+
+def load_sample_messages():
+    """Messages of messages_sorted.txt, split the way the pipeline reads them"""
+    sample_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "messages_sorted.txt")
+    with open(sample_path, encoding="utf-8") as file:
+        data = file.read()
+    return ["MSH|" + msg.strip().replace('\n', '\r') for msg in data.split('MSH|') if msg.strip()]
+
+# Fields the pipeline reads from every message
+HOT_FIELDS = [("MSH", 7), ("MSH", 10), ("MSH", 12), ("PID", 3), ("PID", 5), ("PID", 7), ("PID", 11),
+              ("PID", 13), ("PID", 14), ("PID", 18), ("PID", 19), ("PV1", 7), ("PV1", 8), ("PV1", 9)]
+
+def read_fields_tokenizer(message):
+    h = hl7_tokenizer.parse(message)
+    return [h.get(segment_type, index) for segment_type, index in HOT_FIELDS]
+
+def read_fields_hl7(message):
+    import hl7
+    h = hl7.parse(message)
+    first_segments = {}
+    for segment in h:
+        first_segments.setdefault(str(segment[0]), segment)
+    values = []
+    for segment_type, index in HOT_FIELDS:
+        segment = first_segments.get(segment_type)
+        values.append(str(segment[index]) if segment is not None and index < len(segment) else '')
+    return values
+
+# hl7_tokenizer vs. hl7.parse reading the hot-path fields
+def bench_tokenizer(messages, hl7_messages):
+    sample = load_sample_messages()
+    for message in sample:
+        assert read_fields_tokenizer(message) == read_fields_hl7(message), message.split('\r')[0]
+
+    print(f"{'parser':>10} {'messages':>9} {'seconds':>8} {'us/msg':>8} {'msg/s':>9}")
+    for name, reader, count in (("tokenizer", read_fields_tokenizer, messages), ("hl7.parse", read_fields_hl7, hl7_messages)):
+        if not count:
+            continue
+        start = time.perf_counter()
+        for i in range(count):
+            reader(sample[i % len(sample)])
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10} {count:>9} {elapsed:>8.2f} {elapsed / count * 1e6:>8.1f} {count / elapsed:>9.0f}")
+
+# MSH-7 sort key extraction per million messages
+def bench_timestamp_key(messages):
+    import sort
+    sample = load_sample_messages()
+    # Mix in the precisions and offsets seen across sending facilities
+    variants = []
+    for message in sample:
+        fields = message.split('|', 7)
+        for timestamp in (fields[6], fields[6][:12], fields[6][:12] + "30.25", fields[6][:12] + "+0100", fields[6][:12] + "-0500"):
+            variants.append('|'.join(fields[:6] + [timestamp] + fields[7:]))
+
+    sort.timestamp_failures.clear()
+    start = time.perf_counter()
+    for i in range(messages):
+        sort.timestamp_key(variants[i % len(variants)])
+    elapsed = time.perf_counter() - start
+    print(f"{messages} messages in {elapsed:.2f} s, {elapsed / messages * 1e6:.2f} s per 1M messages, "
+          f"{sum(sort.timestamp_failures.values())} failures")
+
+# Viewer search: inverted index vs. str.contains over every row
+def bench_search_index(rows, queries):
+    import numpy as np
+    import pandas as pd
+    import search_index
+    sample = load_sample_messages()
+    records = []
+    for i in range(rows):
+        patient_data = make_patient(random.randrange(max(rows // 10, 1)))
+        records.append({
+            "Message Control ID": f"{i:012d}",
+            "MRN": f"{patient_data['mrn']}^^^UAReg^MR",
+            "Last Name": patient_data["last_name"].upper(),
+            "Fixed Message": sample[i % len(sample)],
+        })
+    df = pd.DataFrame(records)
+    columns = {"Message Control ID": "message_id_key", "MRN": "mrn_key", "Last Name": "last_name_key"}
+    start = time.perf_counter()
+    for column, key in columns.items():
+        df[key] = df[column].str.lower().astype("category")
+    index = search_index.MessageSearchIndex(df, columns, texts=df["Fixed Message"])
+    print(f"{rows} rows, index built in {time.perf_counter() - start:.2f} s")
+
+    workload = []
+    for _ in range(queries):
+        record = records[random.randrange(rows)]
+        workload.append({
+            "Message Control ID": record["Message Control ID"][-random.randint(2, 6):],
+            "MRN": record["MRN"][1:random.randint(4, 9)],
+            "Last Name": record["Last Name"][:random.randint(2, 5)],
+        })
+
+    print(f"{'method':>12} {'ms/query':>9}")
+    start = time.perf_counter()
+    indexed = [index.search(query) for query in workload]
+    elapsed = time.perf_counter() - start
+    print(f"{'index':>12} {elapsed / queries * 1e3:>9.2f}")
+
+    start = time.perf_counter()
+    for query, expected in zip(workload, indexed):
+        mask = np.ones(rows, dtype=bool)
+        for column, value in query.items():
+            mask &= df[column].str.contains(value, case=False, regex=False).to_numpy()
+        assert np.array_equal(np.flatnonzero(mask), expected), query
+    elapsed = time.perf_counter() - start
+    print(f"{'str.contains':>12} {elapsed / queries * 1e3:>9.2f}")
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        index.search({}, random.choice(["chronic headaches", "vasquez", "obx tx", "2024"]))
+    elapsed = time.perf_counter() - start
+    print(f"{'text index':>12} {elapsed / queries * 1e3:>9.2f}")
+
+# Viewer HTML rendering of OBX-heavy messages, uncached and cached
+def bench_render(messages, segments):
+    import message_render
+    sample = load_sample_messages()
+    workload = []
+    for i in range(messages):
+        patient_data = make_patient(i)
+        lines = sample[i % len(sample)].split('\r')[:3] + make_obx_nte_message(patient_data, segments)
+        workload.append('\r'.join(lines))
+
+    message_render.render_message.cache_clear()
+    print(f"{'pass':>8} {'ms/msg':>8} {'KB/msg':>8}")
+    for name in ("render", "cached"):
+        start = time.perf_counter()
+        size = sum(len(message_render.render_message(message)) for message in workload)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8} {elapsed / messages * 1e3:>8.2f} {size / messages / 1024:>8.0f}")
+
+# Feed-wide field change summary of a de-identified feed against its original
+def bench_diff(copies):
+    import message_diff
+    import message_index
+    dc = load_dict_creator()
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = os.path.join(tmp, "raw.txt")
+        output = os.path.join(tmp, "messages_deidentified.txt")
+        write_sample_feed(feed, copies)
+        cwd = os.getcwd()
+        os.chdir(tmp)  # extract_unique_patients writes result.json to the working directory
+        try:
+            patient_dict, message_map = dc.extract_unique_patients(feed, os.path.join(tmp, "output.txt"))
+        finally:
+            os.chdir(cwd)
+        dc.compile(feed, patient_dict, message_map, output)
+
+        with message_index.MessageIndex(output) as fixed_index, message_index.MessageIndex(feed) as raw_index:
+            start = time.perf_counter()
+            messages, summary = message_diff.summarize_changes(zip(fixed_index, raw_index))
+            elapsed = time.perf_counter() - start
+        print(f"{messages} messages in {elapsed:.2f} s, {messages / elapsed:.0f} msg/s")
+        for label, (changed, present) in summary.items():
+            print(f"{label:>16} changed in {100 * changed / present:5.1f}% of {present} messages")
+
+def write_obx_nte_feed(path, messages, segments):
+    """Writes messages with a PID name and OBX/NTE free text mentioning it"""
+    with open(path, "w", encoding="utf-8") as file:
+        for i in range(messages):
+            patient_data = make_patient(i)
+            file.write(f"MSH|^~\\&|EPIC|VUMC|||{20240101000000 + i}||ORU^R01|MSG{i:08d}|P|2.3\n")
+            file.write(f"PID|1||{patient_data['mrn']}||{patient_data['last_name']}^{patient_data['first_name']}||"
+                       f"{patient_data['birthdate']}|F|||1 MAIN ST^^NASHVILLE^TN^37203||615-344-9551|||||"
+                       f"A{i:09d}|{patient_data['SSN']}\n")
+            file.write("\n".join(make_obx_nte_message(patient_data, segments)) + "\n")
+
+def redact_file_line_loop(input_file, output_file):
+    """The original single-threaded redact_hl7_file loop"""
+    import redact
+    with open(input_file, "r") as inFile, open(output_file, "w") as outFile:
+        first_name = None
+        last_name = None
+        for line in inFile:
+            line = line.rstrip()
+            if line.startswith("MSH"):
+                first_name = None
+                last_name = None
+            if line.startswith("PID"):
+                segment = hl7_tokenizer.Segment(line, hl7_tokenizer.DEFAULT_SEPARATORS)
+                if len(segment) > 5:
+                    name_parts = segment.components(5)
+                    if len(name_parts) > 1:
+                        first_name = name_parts[1]
+                        last_name = name_parts[0]
+            if line.strip():
+                outFile.write(redact.redact_hl7_line(line, first_name, last_name) + "\n")
+            else:
+                outFile.write("\n")
+
+# Line loop vs. chunked (and parallel) redaction of an OBX/NTE-heavy feed
+def bench_redact(messages, segments, workers_list, chunk_mb):
+    import redact
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = os.path.join(tmp, "raw.txt")
+        write_obx_nte_feed(feed, messages, segments)
+        size = os.path.getsize(feed)
+        print(f"{messages} messages ({segments} OBX/NTE each), {size / 2**20:.1f} MB")
+        print(f"{'run':>12} {'seconds':>8} {'MB/s':>7} {'speedup':>8}")
+
+        reference_path = os.path.join(tmp, "line_loop.txt")
+        start = time.perf_counter()
+        redact_file_line_loop(feed, reference_path)
+        baseline = time.perf_counter() - start
+        print(f"{'line loop':>12} {baseline:>8.2f} {size / 2**20 / baseline:>7.1f} {1:>7.2f}x")
+        with open(reference_path, "rb") as file:
+            reference = file.read()
+
+        for workers in workers_list:
+            output = os.path.join(tmp, f"out_{workers}.txt")
+            start = time.perf_counter()
+            redact.redact_hl7_file(feed, output, workers=workers, chunk_size=int(chunk_mb * 2**20))
+            elapsed = time.perf_counter() - start
+            label = f"{workers} workers"
+            print(f"{label:>12} {elapsed:>8.2f} {size / 2**20 / elapsed:>7.1f} {baseline / elapsed:>7.2f}x")
+            with open(output, "rb") as file:
+                assert file.read() == reference, f"redact_hl7_file with {workers} workers differs from the line loop"
+
+# Per-value cost of the pseudonym generators, and duplicates among keyed values
+def bench_pseudonyms(count, extra_names, keyed):
+    if extra_names:
+        RG.use_extra_names()
+    if keyed:
+        RG.use_pseudonym_key(b"benchmark key")
+    generators = [
+        ("name", RG.generate_unique_fake_name),
+        ("phone", RG.generate_phone_number),
+        ("ssn", RG.generate_SSN),
+        ("mrn", RG.generate_MRN),
+        ("account", RG.generate_account_number),
+    ]
+    capacity = RG.capacity()
+    print(f"{'space':>8} {'capacity':>16} {'drawn':>10} {'us/value':>9} {'unique':>9}")
+    for space, generate in generators:
+        drawn = min(count, capacity[space][1])
+        start = time.perf_counter()
+        if keyed:
+            values = [generate(f"W{i:09d}") for i in range(drawn)]
+        else:
+            values = [generate() for _ in range(drawn)]
+        elapsed = time.perf_counter() - start
+        unique = "yes" if len(set(values)) == drawn else f"{drawn - len(set(values))} dup"
+        print(f"{space:>8} {capacity[space][1]:>16,} {drawn:>10} {elapsed / drawn * 1e6:>9.2f} {unique:>9}")
+
+# Per-record vs. batch generation of complete fake identities
+def bench_identities(count, batch):
+    RG.use_extra_names()  # Both methods draw count names
+    birthdates = [f"19{random.randint(20, 99)}{random.randint(1, 12):02}{random.randint(1, 28):02}" for _ in range(count)]
+    states = [random.choice(["TN", "KY", "AL", ""]) for _ in range(count)]
+    print(f"{'method':>10} {'seconds':>8} {'records/s':>10} {'speedup':>8}")
+
+    start = time.perf_counter()
+    for birthdate, state in zip(birthdates, states):
+        RG.generate_identity(birthdate, state)
+    baseline = time.perf_counter() - start
+    print(f"{'per-record':>10} {baseline:>8.2f} {count / baseline:>10.0f} {1:>7.2f}x")
+
+    start = time.perf_counter()
+    for offset in range(0, count, batch):
+        RG.generate_identities(birthdates[offset:offset + batch], states[offset:offset + batch])
+    elapsed = time.perf_counter() - start
+    print(f"{'batch':>10} {elapsed:>8.2f} {count / elapsed:>10.0f} {baseline / elapsed:>7.2f}x")
+
+def make_free_text_dates(count):
+    """Dates as written in PID-7, timestamps and OBX/NTE free text"""
+    month_names = ["January", "Feb", "March", "Apr", "May", "June", "Jul", "Aug.", "Sept", "Oct", "November", "Dec"]
+    dates = []
+    for _ in range(count):
+        year, month, day = random.randint(1930, 2024), random.randint(1, 12), random.randint(1, 28)
+        dates.append(random.choice([
+            f"{year}{month:02}{day:02}",
+            f"{year}{month:02}{day:02}{random.randint(0, 235959):06}",
+            f"{month:02}/{day:02}/{year}",
+            f"{month}/{day}/{year}",
+            f"{month}-{day}-{year}",
+            f"{day + 12 if day < 17 else day}/{month:02}/{year}",
+            f"{year}-{month:02}-{day:02}",
+            f"{month_names[month - 1]} {day}, {year}",
+            f"{day} {month_names[month - 1]} {year}",
+        ]))
+    return dates
+
+# normalize_date on a mix of free-text dates, uncached and with a warm cache
+def bench_normalize_date(distinct, lookups):
+    dc = load_dict_creator()
+    dates = make_free_text_dates(distinct)
+    workload = [random.choice(dates) for _ in range(lookups)]
+    uncached = dc.normalize_date.__wrapped__
+
+    start = time.perf_counter()
+    for date in workload:
+        uncached(date)
+    elapsed = time.perf_counter() - start
+    print(f"uncached: {elapsed / lookups * 1e6:.2f} us/date")
+
+    dc.normalize_date.cache_clear()
+    start = time.perf_counter()
+    for date in workload:
+        dc.normalize_date(date)
+    elapsed = time.perf_counter() - start
+    info = dc.normalize_date.cache_info()
+    print(f"cached:   {elapsed / lookups * 1e6:.2f} us/date ({info.hits / lookups:.0%} hits, "
+          f"{distinct} distinct dates, cache size {info.maxsize})")
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size so far (Linux reports ru_maxrss in KB)"""
+    return resource.getrusage(who).ru_maxrss / 1024
+
+# Every pipeline stage on a synthetic feed, reported as JSON
+def bench_end_to_end(config, workers, json_path):
+    import app
+    import message_index
+    import redact
+    import sort
+    import synthetic_feed
+    dc = load_dict_creator()
+    stages = {}
+
+    def run_stage(name, function, *args, **kwargs):
+        # Stage output is kept off stdout, which may carry the JSON report
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        stages[name] = {
+            "seconds": round(elapsed, 4),
+            "messages_per_second": round(config.messages / elapsed, 1),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "peak_worker_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+        }
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = os.path.join(tmp, "raw.txt")
+        deidentified = os.path.join(tmp, "messages_deidentified.txt")
+        source_map = deidentified + message_index.SOURCE_MAP_SUFFIX
+
+        start = time.perf_counter()
+        patients = synthetic_feed.generate_feed(feed, config)
+        generate_seconds = time.perf_counter() - start
+
+        cwd = os.getcwd()
+        os.chdir(tmp)  # extract_unique_patients writes result.json to the working directory
+        try:
+            run_stage("sort_hl7_messages", sort.sort_hl7_messages, feed, os.path.join(tmp, "messages_sorted.txt"))
+            patient_dict, message_map = run_stage("extract_unique_patients", dc.extract_unique_patients,
+                                                  feed, os.path.join(tmp, "output.txt"))
+            run_stage("compile", dc.compile, feed, patient_dict, message_map, deidentified, workers=workers,
+                      map_file=source_map, source_file=feed)
+            run_stage("redact_hl7_file", redact.redact_hl7_file, feed, os.path.join(tmp, "messages_redacted.txt"),
+                      workers=workers)
+            with message_index.MessageIndex(deidentified) as fixed_index, \
+                    message_index.MessageIndex(feed) as raw_index:
+                run_stage("viewer_parse_hl7_messages", app.build_message_table,
+                          fixed_index, raw_index, message_index.SourceMap(source_map))
+        finally:
+            os.chdir(cwd)
+        feed_bytes = os.path.getsize(feed)
+
+    total = sum(stage["seconds"] for stage in stages.values())
+    report = {
+        "benchmark": "end-to-end",
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "workers": workers,
+        "feed": {
+            "messages": config.messages,
+            "patients": patients,
+            "bytes": feed_bytes,
+            "repeat_ratio": config.repeat_ratio,
+            "versions": list(config.versions),
+            "seed": config.seed,
+            "generate_seconds": round(generate_seconds, 4),
+        },
+        "stages": stages,
+        "total_seconds": round(total, 4),
+        "messages_per_second": round(config.messages / total, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        for name, stage in stages.items():
+            print(f"{name:>26} {stage['seconds']:>8.2f} s {stage['messages_per_second']:>10.0f} msg/s "
+                  f"{stage['peak_rss_mb']:>8.1f} MB")
+        print(f"{'total':>26} {total:>8.2f} s {report['messages_per_second']:>10.0f} msg/s, report in {json_path}")
+    else:
+        print(json.dumps(report, indent=2))
+
+# MLLP server throughput over loopback: senders -> de-identifying server -> downstream stand-in
+def bench_mllp(messages, connections, queue_size):
+    import asyncio
+    import mllp
+    import synthetic_feed
+    dc = load_dict_creator()
+
+    async def run(feed, count, tmp):
+        receiver = mllp.MLLPServer(lambda message: message, mllp.FileSink(os.path.join(tmp, "received.txt")))
+        downstream = await receiver.start("127.0.0.1", 0)
+        server = dc.mllp_server(mllp.MLLPForwarder("127.0.0.1", downstream), os.path.join(tmp, "output.txt"),
+                                queue_size=queue_size)
+        port = await server.start("127.0.0.1", 0)
+        start = time.perf_counter()
+        codes, sent = await mllp.send_file("127.0.0.1", port, feed, count)
+        elapsed = time.perf_counter() - start
+        await server.close()
+        await receiver.close()
+        return codes, sent, elapsed
+
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = os.path.join(tmp, "raw.txt")
+        synthetic_feed.generate_feed(feed, synthetic_feed.FeedConfig(messages))
+        state = RG.snapshot_state()
+        for count in connections:
+            # Every run registers the same patients again
+            RG.restore_state(state)
+            codes, sent, elapsed = asyncio.run(run(feed, count, tmp))
+            print(f"{count:>4} connection(s): {sent / elapsed:>8.0f} msg/s "
+                  f"({', '.join(f'{n} {code}' for code, n in sorted(codes.items()))})")
+
+def main():
+    parser = argparse.ArgumentParser(description="BearDown benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    index_parser = subparsers.add_parser("patient-index", help="patient matching cost vs. patient count")
+    index_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    index_parser.add_argument("--lookups", type=int, default=20000)
+
+    compile_parser = subparsers.add_parser("compile", help="serial vs. parallel compile throughput")
+    compile_parser.add_argument("--copies", type=int, default=2000, help="copies of messages_sorted.txt in the feed")
+    compile_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+
+    sanitize_parser = subparsers.add_parser("sanitize", help="sanitize_non_pid_segment on OBX/NTE-heavy messages")
+    sanitize_parser.add_argument("--patients", type=int, default=200)
+    sanitize_parser.add_argument("--segments", type=int, default=300, help="OBX/NTE segments per message")
+
+    tokenizer_parser = subparsers.add_parser("tokenizer", help="hl7_tokenizer vs. hl7.parse on the sample feed")
+    tokenizer_parser.add_argument("--messages", type=int, default=1000000, help="messages read with the tokenizer")
+    tokenizer_parser.add_argument("--hl7-messages", type=int, default=50000,
+                                  help="messages read with hl7.parse (0 to skip; it is ~100x slower)")
+
+    timestamp_parser = subparsers.add_parser("timestamp-key", help="sort key extraction cost")
+    timestamp_parser.add_argument("--messages", type=int, default=1000000)
+
+    search_parser = subparsers.add_parser("search-index", help="viewer search index vs. str.contains")
+    search_parser.add_argument("--rows", type=int, default=200000)
+    search_parser.add_argument("--queries", type=int, default=50)
+
+    render_parser = subparsers.add_parser("render", help="viewer HTML rendering of OBX-heavy messages")
+    render_parser.add_argument("--messages", type=int, default=100)
+    render_parser.add_argument("--segments", type=int, default=500, help="OBX/NTE segments per message")
+
+    diff_parser = subparsers.add_parser("diff", help="feed-wide change summary of a de-identified feed")
+    diff_parser.add_argument("--copies", type=int, default=2000, help="copies of messages_sorted.txt in the feed")
+
+    redact_parser = subparsers.add_parser("redact", help="line loop vs. chunked parallel redact_hl7_file")
+    redact_parser.add_argument("--messages", type=int, default=5000)
+    redact_parser.add_argument("--segments", type=int, default=40, help="OBX/NTE segments per message")
+    redact_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    redact_parser.add_argument("--chunk-mb", type=float, default=4.0)
+
+    pseudonym_parser = subparsers.add_parser("pseudonyms", help="unique fake value generation cost")
+    pseudonym_parser.add_argument("--count", type=int, default=1000000, help="values drawn per generator")
+    pseudonym_parser.add_argument("--extra-names", action="store_true", help="extend the name lists with names.txt")
+    pseudonym_parser.add_argument("--keyed", action="store_true", help="keyed-deterministic values of distinct MRNs")
+
+    identities_parser = subparsers.add_parser("identities", help="per-record vs. batch fake identity generation")
+    identities_parser.add_argument("--count", type=int, default=200000, help="records generated by each method")
+    identities_parser.add_argument("--batch", type=int, default=65536)
+
+    date_parser = subparsers.add_parser("normalize-date", help="date normalization of free-text dates")
+    date_parser.add_argument("--distinct", type=int, default=20000, help="distinct date strings")
+    date_parser.add_argument("--lookups", type=int, default=500000)
+
+    end_to_end_parser = subparsers.add_parser("end-to-end", help="every pipeline stage on a synthetic feed (JSON)")
+    end_to_end_parser.add_argument("--messages", type=int, default=20000)
+    end_to_end_parser.add_argument("--patients", type=int, help="most distinct patients (default: half the messages)")
+    end_to_end_parser.add_argument("--repeat-ratio", type=float, default=0.5)
+    end_to_end_parser.add_argument("--versions", nargs="+", choices=["2.1", "2.4", "2.5"], default=["2.1", "2.4", "2.5"])
+    end_to_end_parser.add_argument("--workers", type=int, default=1, help="workers of compile and redact_hl7_file")
+    end_to_end_parser.add_argument("--json", metavar="PATH", help="write the report to PATH instead of stdout")
+
+    mllp_parser = subparsers.add_parser("mllp", help="MLLP server throughput over loopback")
+    mllp_parser.add_argument("--messages", type=int, default=5000)
+    mllp_parser.add_argument("--connections", type=int, nargs="+", default=[1, 4, 16, 64])
+    mllp_parser.add_argument("--queue-size", type=int, default=1000)
+
+    args = parser.parse_args()
+    random.seed(0)
+    if args.benchmark == "patient-index":
+        bench_patient_index(args.sizes, args.lookups)
+    elif args.benchmark == "compile":
+        bench_compile(args.copies, args.workers)
+    elif args.benchmark == "sanitize":
+        bench_sanitize(args.patients, args.segments)
+    elif args.benchmark == "tokenizer":
+        bench_tokenizer(args.messages, args.hl7_messages)
+    elif args.benchmark == "timestamp-key":
+        bench_timestamp_key(args.messages)
+    elif args.benchmark == "search-index":
+        bench_search_index(args.rows, args.queries)
+    elif args.benchmark == "render":
+        bench_render(args.messages, args.segments)
+    elif args.benchmark == "diff":
+        bench_diff(args.copies)
+    elif args.benchmark == "redact":
+        bench_redact(args.messages, args.segments, args.workers, args.chunk_mb)
+    elif args.benchmark == "pseudonyms":
+        bench_pseudonyms(args.count, args.extra_names, args.keyed)
+    elif args.benchmark == "identities":
+        bench_identities(args.count, args.batch)
+    elif args.benchmark == "normalize-date":
+        bench_normalize_date(args.distinct, args.lookups)
+    elif args.benchmark == "end-to-end":
+        import synthetic_feed
+        config = synthetic_feed.FeedConfig(args.messages, args.patients, args.repeat_ratio, args.versions)
+        bench_end_to_end(config, args.workers, args.json)
+    elif args.benchmark == "mllp":
+        bench_mllp(args.messages, args.connections, args.queue_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Lightweight HL7 v2 tokenizer for the hot paths of the pipeline.
+
+A message is split once into segments; each segment is split into fields
+only when one of its fields is first read, and components are split on
+demand. No object tree is built, so reading a handful of fields (MSH-7,
+PID-3, PV1-7, ...) costs a few str.split calls instead of a full hl7.parse.
+
+Field numbering follows the HL7 standard and the hl7 package: segment[0]
+is the segment type, MSH-1 is the field separator and MSH-2 the encoding
+characters. Missing fields read as empty strings.
+"""
+
+SEGMENT_SEPARATORS = ('\r', '\n')
+
+# Field, component, repetition, escape and subcomponent separators
+DEFAULT_SEPARATORS = ('|', '^', '~', '\\', '&')
+
+class Segment:
+    """One segment of a message, split into fields on first access"""
+    __slots__ = ('text', 'separators', '_fields')
+
+    def __init__(self, text, separators):
+        self.text = text
+        self.separators = separators
+        self._fields = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            fields = self.text.split(self.separators[0])
+            if fields[0] == 'MSH':
+                # MSH-1 is the field separator itself
+                fields.insert(1, self.separators[0])
+            self._fields = fields
+        return self._fields
+
+    @property
+    def type(self):
+        return self.text[:3]
+
+    def __getitem__(self, index):
+        fields = self.fields
+        return fields[index] if index < len(fields) else ''
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f"Segment({self.text!r})"
+
+    def field(self, index, repetition=None):
+        """Field by HL7 number, optionally one repetition (1-based)"""
+        value = self[index]
+        if repetition is not None:
+            repetitions = value.split(self.separators[2])
+            value = repetitions[repetition - 1] if repetition <= len(repetitions) else ''
+        return value
+
+    def component(self, index, component, repetition=1):
+        """Component (1-based) of a field; uses the first repetition by default"""
+        value = self.field(index, repetition)
+        components = value.split(self.separators[1])
+        return components[component - 1] if component <= len(components) else ''
+
+    def components(self, index, repetition=None):
+        return self.field(index, repetition).split(self.separators[1])
+
+class Message:
+    """
+    Tokenized HL7 message. Iterating yields Segment objects; segment() and
+    segments() find segments by type without splitting the others.
+    """
+    __slots__ = ('text', 'lines', 'separators', '_segments')
+
+    def __init__(self, text):
+        self.text = text
+        if '\n' in text:
+            text = text.replace('\r\n', '\r').replace('\n', '\r')
+        lines = text.split('\r')
+        # Trailing separator does not make an extra (empty) segment
+        if len(lines) > 1 and lines[-1] == '':
+            lines.pop()
+        self.lines = lines
+        self.separators = read_separators(lines[0] if lines else '')
+        self._segments = [None] * len(lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        segment = self._segments[index]
+        if segment is None:
+            segment = self._segments[index] = Segment(self.lines[index], self.separators)
+        return segment
+
+    def __iter__(self):
+        for index in range(len(self.lines)):
+            yield self[index]
+
+    def __str__(self):
+        return '\r'.join(self.lines)
+
+    def segment_types(self):
+        return [line[:3] for line in self.lines]
+
+    def segment(self, segment_type):
+        """First segment of the given type, or None"""
+        for index, line in enumerate(self.lines):
+            if line.startswith(segment_type) and line[3:4] in (self.separators[0], ''):
+                return self[index]
+        return None
+
+    def segments(self, segment_type):
+        for index, line in enumerate(self.lines):
+            if line.startswith(segment_type) and line[3:4] in (self.separators[0], ''):
+                yield self[index]
+
+    def get(self, segment_type, index, component=None):
+        """Value of e.g. ('PID', 5, 2); empty string when missing"""
+        segment = self.segment(segment_type)
+        if segment is None:
+            return ''
+        if component is None:
+            return segment[index]
+        return segment.component(index, component)
+
+def read_separators(msh_line):
+    """
+    Returns (field, component, repetition, escape, subcomponent) separators
+    as declared in MSH-1 and MSH-2, falling back to the standard |^~\\&.
+    """
+    if not msh_line.startswith('MSH') or len(msh_line) < 4:
+        return DEFAULT_SEPARATORS
+    field_sep = msh_line[3]
+    encoding = msh_line[4:].split(field_sep, 1)[0]
+    defaults = '^~\\&'
+    encoding = encoding + defaults[len(encoding):] if len(encoding) < 4 else encoding[:4]
+    return (field_sep, encoding[0], encoding[1], encoding[2], encoding[3])
+
+def parse(message):
+    """Tokenizes one HL7 message (segments separated by \\r or \\n)"""
+    return Message(message)
+
+def header_field(message, index):
+    """
+    Reads MSH-<index> straight from the header line without tokenizing the
+    rest of the message.
+    """
+    end = len(message)
+    for separator in SEGMENT_SEPARATORS:
+        position = message.find(separator)
+        if position != -1 and position < end:
+            end = position
+    header = message[:end]
+    if not header.startswith('MSH') or len(header) < 4:
+        return ''
+    if index == 1:
+        return header[3]
+    fields = header.split(header[3], index)
+    # fields[0] is 'MSH', fields[1] is MSH-2
+    return fields[index - 1] if index - 1 < len(fields) else ''
@@ -0,0 +1,139 @@
+"""
+Field-aware comparison of de-identified messages with their raw originals.
+
+Segments are aligned by type and set-ID (field 1 when it is numeric), so
+an added or dropped segment does not shift every following pair, and
+aligned segments are compared field by field and component by component.
+Identical messages and segments are skipped with a single string
+comparison, which keeps a whole-feed summary fast: most segments of a
+de-identified message are unchanged.
+"""
+from collections import Counter, namedtuple
+
+import hl7_tokenizer
+
+# One changed field or component: label is e.g. "PID-5.1"
+FieldChange = namedtuple("FieldChange", ["label", "raw", "fixed"])
+
+# One aligned segment pair; raw or fixed is None for a removed or added segment
+SegmentDiff = namedtuple("SegmentDiff", ["key", "raw", "fixed", "changes"])
+
+def segment_set_id(segment):
+    """Field 1 when it is a numeric set-ID (OBX-1, NK1-1, ...), else ''"""
+    if segment.type == "MSH":
+        return ""
+    value = segment[1]
+    return value if value.isdigit() else ""
+
+def keyed_segments(message):
+    """
+    (key, segment) pairs in message order. The key is the segment type, the
+    set-ID and the occurrence of that type/set-ID pair, e.g. ('OBX', '2', 0).
+    """
+    seen = Counter()
+    keyed = []
+    for segment in message:
+        if not segment.text.strip():
+            continue
+        type_and_set_id = (segment.type, segment_set_id(segment))
+        keyed.append((type_and_set_id + (seen[type_and_set_id],), segment))
+        seen[type_and_set_id] += 1
+    return keyed
+
+def key_label(key):
+    segment_type, set_id, occurrence = key
+    label = f"{segment_type}[{set_id}]" if set_id else segment_type
+    return label if not occurrence else f"{label}#{occurrence + 1}"
+
+def field_changes(raw_segment, fixed_segment):
+    """Changed fields of two aligned segments, at component level where a field has components"""
+    changes = []
+    component_separator = raw_segment.separators[1]
+    raw_fields = raw_segment.fields
+    fixed_fields = fixed_segment.fields
+    segment_type = raw_segment.type
+    for index in range(1, max(len(raw_fields), len(fixed_fields))):
+        raw_value = raw_segment[index]
+        fixed_value = fixed_segment[index]
+        if raw_value == fixed_value:
+            continue
+        label = f"{segment_type}-{index}"
+        if component_separator in raw_value or component_separator in fixed_value:
+            raw_components = raw_value.split(component_separator)
+            fixed_components = fixed_value.split(component_separator)
+            for component in range(max(len(raw_components), len(fixed_components))):
+                raw_component = raw_components[component] if component < len(raw_components) else ""
+                fixed_component = fixed_components[component] if component < len(fixed_components) else ""
+                if raw_component != fixed_component:
+                    changes.append(FieldChange(f"{label}.{component + 1}", raw_component, fixed_component))
+        else:
+            changes.append(FieldChange(label, raw_value, fixed_value))
+    return changes
+
+def diff_messages(fixed_text, raw_text):
+    """
+    Aligned segment diff of a de-identified message against its original.
+    Returns SegmentDiffs in raw message order, added segments last.
+    """
+    fixed_segments = dict(keyed_segments(hl7_tokenizer.parse(fixed_text)))
+    diffs = []
+    for key, raw_segment in keyed_segments(hl7_tokenizer.parse(raw_text)):
+        fixed_segment = fixed_segments.pop(key, None)
+        if fixed_segment is None:
+            diffs.append(SegmentDiff(key, raw_segment, None, []))
+        elif fixed_segment.text == raw_segment.text:
+            diffs.append(SegmentDiff(key, raw_segment, fixed_segment, []))
+        else:
+            diffs.append(SegmentDiff(key, raw_segment, fixed_segment, field_changes(raw_segment, fixed_segment)))
+    for key, fixed_segment in fixed_segments.items():
+        diffs.append(SegmentDiff(key, None, fixed_segment, []))
+    return diffs
+
+def changed_fields(fixed_text, raw_text):
+    """
+    Field labels (e.g. 'PID-5') that differ between the two messages, with
+    the segments only one of them has as e.g. 'NK1 (removed)' or 'ZPI
+    (added)', exactly as diff_messages aligns them; and the segment types
+    present in either message.
+    """
+    raw_message = hl7_tokenizer.parse(raw_text)
+    if fixed_text == raw_text:
+        return set(), set(raw_message.segment_types())
+    fixed_message = hl7_tokenizer.parse(fixed_text)
+    present = set(raw_message.segment_types()) | set(fixed_message.segment_types())
+    fixed_segments = dict(keyed_segments(fixed_message))
+    changed = set()
+    for key, raw_segment in keyed_segments(raw_message):
+        fixed_segment = fixed_segments.pop(key, None)
+        if fixed_segment is None:
+            changed.add(f"{raw_segment.type} (removed)")
+        elif fixed_segment.text != raw_segment.text:
+            # Only the aligned partner counts; an identical line elsewhere in the message does not
+            for change in field_changes(raw_segment, fixed_segment):
+                changed.add(change.label.split(".")[0])
+    for fixed_segment in fixed_segments.values():
+        changed.add(f"{fixed_segment.type} (added)")
+    return changed, present
+
+def field_sort_key(label):
+    segment_type, _, field = label.partition("-")
+    return (segment_type, int(field) if field.isdigit() else -1, label)
+
+def summarize_changes(pairs):
+    """
+    Feed-wide change summary over (fixed_text, raw_text) pairs. Returns the
+    message count and, per changed field, (messages where it changed,
+    messages containing its segment type), ordered by segment and field.
+    """
+    messages = 0
+    changed_counts = Counter()
+    present_counts = Counter()
+    for fixed_text, raw_text in pairs:
+        messages += 1
+        changed, present = changed_fields(fixed_text, raw_text)
+        changed_counts.update(changed)
+        present_counts.update(present)
+    summary = {}
+    for label in sorted(changed_counts, key=field_sort_key):
+        summary[label] = (changed_counts[label], present_counts[label[:3]])
+    return messages, summary
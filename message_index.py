@@ -0,0 +1,193 @@
+"""
+Memory-mapped reader for raw HL7 files.
+
+The file is scanned once for segment-start 'MSH|' boundaries and the start
+offsets are kept as a compact int64 array, so any stage can iterate the
+messages or read message N without loading the feed into memory. The index
+can be persisted next to the file (<file>.idx) and is reused as long as the
+file size and modification time are unchanged.
+
+Stages that rewrite a feed can also emit a source map next to their output
+(<output>.map): one tab-separated line per output message with the byte
+offset and length of the message it was made from and its control ID, so
+output and input messages are paired directly instead of by position.
+"""
+import mmap
+import os
+import struct
+from array import array
+
+from hl7_tokenizer import header_field
+
+SIDECAR_SUFFIX = '.idx'
+SOURCE_MAP_SUFFIX = '.map'
+SIDECAR_MAGIC = b'HL7IDX01'
+# magic, file size, file mtime (ns), message count
+SIDECAR_HEADER = struct.Struct('<8sqqq')
+
+def normalize_message(text):
+    """
+    Normalizes one message the way the pipeline's readers always have:
+    surrounding whitespace stripped and segments separated by '\\r'.
+    """
+    return text.replace('\r\n', '\n').replace('\r', '\n').strip().replace('\n', '\r')
+
+def scan_offsets(data):
+    """Start offsets of every 'MSH|' that begins a line (or the file)"""
+    offsets = array('q')
+    position = data.find(b'MSH|')
+    while position != -1:
+        if position == 0 or data[position - 1] in (0x0A, 0x0D):
+            offsets.append(position)
+        position = data.find(b'MSH|', position + 4)
+    return offsets
+
+class MessageIndex:
+    """
+    Offset index of the messages in an HL7 file. Supports len(), iteration
+    and random access (index[n]) to normalized message text.
+    """
+
+    def __init__(self, path, persist=False, encoding='utf-8'):
+        self.path = path
+        self.encoding = encoding
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+
+        self.offsets = self.load_sidecar() if persist else None
+        if self.offsets is None:
+            self.offsets = scan_offsets(self.data)
+            if persist:
+                self.save_sidecar()
+
+    @property
+    def sidecar_path(self):
+        return self.path + SIDECAR_SUFFIX
+
+    def load_sidecar(self):
+        """Returns the persisted offsets, or None if missing or stale"""
+        try:
+            with open(self.sidecar_path, 'rb') as file:
+                magic, size, mtime_ns, count = SIDECAR_HEADER.unpack(file.read(SIDECAR_HEADER.size))
+                if magic != SIDECAR_MAGIC or size != self.size or mtime_ns != self.mtime_ns:
+                    return None
+                offsets = array('q')
+                offsets.fromfile(file, count)
+                return offsets
+        except (OSError, EOFError, struct.error):
+            return None
+
+    def save_sidecar(self):
+        try:
+            with open(self.sidecar_path, 'wb') as file:
+                file.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, self.size, self.mtime_ns, len(self.offsets)))
+                self.offsets.tofile(file)
+        except OSError:
+            pass  # Read-only location, the index is simply rebuilt next time
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def span(self, n):
+        """(byte offset, byte length) of message n in the file"""
+        start = self.offsets[n]
+        end = self.offsets[n + 1] if n + 1 < len(self.offsets) else self.size
+        return start, end - start
+
+    def raw(self, n):
+        """Bytes of message n exactly as stored in the file"""
+        start, length = self.span(n)
+        return self.data[start:start + length]
+
+    def text_at(self, offset, length):
+        """Normalized text of the message stored at a byte span of the file"""
+        return normalize_message(self.data[offset:offset + length].decode(self.encoding))
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self.offsets)
+        if not 0 <= n < len(self.offsets):
+            raise IndexError(n)
+        return self.text_at(*self.span(n))
+
+    def __iter__(self):
+        for n in range(len(self.offsets)):
+            yield self[n]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def iter_messages(path):
+    """Yields the normalized messages of an HL7 file"""
+    with MessageIndex(path) as index:
+        yield from index
+
+class SourceMapWriter:
+    """
+    Writes the source map of an output file while it is written: add(n,
+    message) records that message was made from message n of the source.
+    """
+
+    def __init__(self, path, source_path):
+        self.source = MessageIndex(source_path)
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write(f"#source\t{source_path}\n")
+
+    def add(self, n, message):
+        offset, length = self.source.span(n)
+        control_id = header_field(message, 10).replace('\t', ' ')
+        self.file.write(f"{offset}\t{length}\t{control_id}\n")
+
+    def close(self):
+        self.file.close()
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_source_path(path):
+    """Source file named in the header of a source map"""
+    with open(path, encoding='utf-8') as file:
+        header = file.readline().rstrip('\n')
+    if not header.startswith('#source\t'):
+        raise ValueError(f"{path} is not a source map")
+    return header.split('\t', 1)[1]
+
+class SourceMap:
+    """
+    Loaded source map: the source path and, per output message, the source
+    byte offset, length and control ID.
+    """
+
+    def __init__(self, path):
+        self.offsets = array('q')
+        self.lengths = array('q')
+        self.control_ids = []
+        self.source_path = read_source_path(path)
+        with open(path, encoding='utf-8') as file:
+            file.readline()
+            for line in file:
+                offset, length, control_id = line.rstrip('\n').split('\t', 2)
+                self.offsets.append(int(offset))
+                self.lengths.append(int(length))
+                self.control_ids.append(control_id)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def span(self, n):
+        return self.offsets[n], self.lengths[n]
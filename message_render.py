@@ -0,0 +1,83 @@
+"""
+HTML rendering of HL7 messages for the viewer.
+
+A message is rendered in one pass: each segment becomes a box with its
+fields inline (field and component labels as tooltips) and a collapsible
+field table. Styling lives in one stylesheet of CSS classes instead of
+inline styles, so the HTML stays small, and rendered messages are cached.
+"""
+import functools
+import html
+
+import hl7_tokenizer
+
+STYLESHEET = """<style>
+.hl7-msg { font-family: Arial, sans-serif; }
+.hl7-seg { background-color: #333; padding: 4px 8px; margin: 4px 0; border-radius: 4px; color: white; line-height: 1.2em; }
+.hl7-seg-MSH { background-color: #225; }
+.hl7-seg-PID { background-color: #252; }
+.hl7-seg-OBR { background-color: #522; }
+.hl7-seg-OBX { background-color: #552; }
+.hl7-invalid { background-color: #faa; padding: 4px 8px; margin: 4px 0; border-radius: 4px; }
+.hl7-name { font-weight: bold; font-size: 1.1em; }
+.hl7-fields { margin-top: 2px; }
+.hl7-f { border: 1px solid #ccc; padding: 2px 4px; margin: 2px; display: inline-block; }
+.hl7-c { border: 1px dashed #aaa; padding: 2px 4px; margin: 2px; display: inline-block; }
+.hl7-more { text-align: right; margin-top: 2px; }
+.hl7-more details { color: white; display: inline-block; }
+.hl7-more summary { cursor: pointer; font-size: 0.9em; margin: 0; }
+.hl7-table { width: 100%; border-collapse: collapse; font-size: 0.9em; margin-top: 2px; }
+.hl7-table td { padding: 2px 4px; border: 1px solid #555; }
+.hl7-table td.hl7-sub { padding-left: 16px; }
+</style>"""
+
+# Segment types with their own background colour
+COLORED_SEGMENTS = {"MSH", "PID", "OBR", "OBX"}
+
+# Rendered messages kept per process
+CACHE_SIZE = 256
+
+def render_segment(segment):
+    """Box for one segment: fields inline, plus a details table of fields and components"""
+    line = segment.text
+    field_sep, component_sep = segment.separators[0], segment.separators[1]
+    if not line or field_sep not in line:
+        return f'<div class="hl7-invalid">Invalid segment: {html.escape(line)}</div>'
+
+    fields = segment.fields
+    seg_name = html.escape(fields[0])
+    encoding_characters = fields[2] if fields[0] == "MSH" else None
+    component_joiner = f" {html.escape(component_sep)} "
+    inline = [f'<span class="hl7-f" title="{seg_name}-00">{seg_name}</span>']
+    rows = [f"<tr><td><strong>{seg_name}-00</strong></td><td>{seg_name}</td></tr>"]
+    for idx in range(1, len(fields)):
+        field = fields[idx]
+        label = f"{seg_name}-{idx:02d}"
+        if component_sep in field and field != encoding_characters:
+            components = [html.escape(sub) for sub in field.split(component_sep)]
+            inline.append(component_joiner.join(
+                f'<span class="hl7-c" title="{label}.{sub_idx}">{sub}</span>'
+                for sub_idx, sub in enumerate(components, start=1)))
+            rows.append(f"<tr><td><strong>{label}</strong></td><td></td></tr>")
+            rows.extend(
+                f'<tr><td class="hl7-sub"><em>{label}.{sub_idx}</em></td><td class="hl7-sub">{sub}</td></tr>'
+                for sub_idx, sub in enumerate(components, start=1))
+        else:
+            value = html.escape(field)
+            inline.append(f'<span class="hl7-f" title="{label}">{value}</span>')
+            rows.append(f"<tr><td><strong>{label}</strong></td><td>{value}</td></tr>")
+
+    color_class = f" hl7-seg-{fields[0]}" if fields[0] in COLORED_SEGMENTS else ""
+    return (
+        f'<div class="hl7-seg{color_class}"><div class="hl7-name">{seg_name}</div>'
+        f'<div class="hl7-fields">{f" {html.escape(field_sep)} ".join(inline)}</div>'
+        f'<div class="hl7-more"><details><summary>Details</summary>'
+        f'<table class="hl7-table">{"".join(rows)}</table></details></div></div>'
+    )
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def render_message(message_text):
+    """HTML of a whole message (stylesheet included), one box per non-empty segment"""
+    message = hl7_tokenizer.parse(message_text)
+    boxes = [render_segment(segment) for segment in message if segment.text.strip()]
+    return f'{STYLESHEET}<div class="hl7-msg">{"".join(boxes)}</div>'
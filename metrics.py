@@ -0,0 +1,191 @@
+"""
+Run metrics for the de-identification pipeline.
+
+Counters and timers live in plain per-process dicts and are written at the
+end of a run as JSON or Prometheus text. Nothing is recorded until enable()
+is called: count() is then a single flag test, timer() returns a shared
+no-op context manager and @timed functions call straight through. An
+optional sampling profiler (SIGPROF, Unix main thread only) records where
+the process spends its CPU time.
+"""
+import collections
+import contextlib
+import functools
+import json
+import os
+import signal
+import time
+
+PREFIX = "beardown"
+
+# Environment variable naming the metrics file of processes without a
+# command line (the Streamlit viewer)
+METRICS_ENV = "BEARDOWN_METRICS"
+
+enabled = False
+
+# (name, labels) -> value, labels being a sorted tuple of (key, value) pairs
+counters = collections.Counter()
+# name -> [calls, seconds]
+timers = {}
+# Collapsed call stack ('file:function;file:function') -> samples
+samples = collections.Counter()
+sample_interval = None
+
+NULL_TIMER = contextlib.nullcontext()
+
+def enable():
+    global enabled
+    enabled = True
+
+def reset():
+    counters.clear()
+    timers.clear()
+    samples.clear()
+
+def count(name, amount=1, **labels):
+    """Adds amount to counter name (with the given labels)"""
+    if enabled:
+        counters[(name, tuple(sorted(labels.items())))] += amount
+
+def add_time(name, seconds):
+    entry = timers.get(name)
+    if entry is None:
+        timers[name] = [1, seconds]
+    else:
+        entry[0] += 1
+        entry[1] += seconds
+
+class Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.perf_counter() - self.start)
+
+def timer(name):
+    """Context manager timing a stage; a no-op while metrics are disabled"""
+    return Timer(name) if enabled else NULL_TIMER
+
+def timed(name):
+    """Decorator timing every call of a hot function while metrics are enabled"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def drain():
+    """Counters and timers recorded since the last drain, e.g. to send from a worker process"""
+    recorded = {"counters": dict(counters), "timers": {name: list(entry) for name, entry in timers.items()}}
+    counters.clear()
+    timers.clear()
+    return recorded
+
+def merge(recorded):
+    """Adds the drain() of another process"""
+    counters.update(recorded["counters"])
+    for name, (calls, seconds) in recorded["timers"].items():
+        entry = timers.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+
+def sample(signum, frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    samples[";".join(reversed(stack))] += 1
+
+def start_profiler(interval=0.005):
+    """Samples the main thread's call stack every interval seconds of CPU time"""
+    global sample_interval
+    sample_interval = interval
+    signal.signal(signal.SIGPROF, sample)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+def stop_profiler():
+    signal.setitimer(signal.ITIMER_PROF, 0)
+    signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+def label_text(labels):
+    return ",".join(f"{key}={value}" for key, value in labels)
+
+def report(top=25):
+    """Everything recorded, as a JSON-ready dict"""
+    counter_report = {}
+    for (name, labels), value in sorted(counters.items()):
+        if labels:
+            counter_report.setdefault(name, {})[label_text(labels)] = value
+        else:
+            counter_report[name] = value
+    data = {
+        "counters": counter_report,
+        "timers": {name: {"calls": calls, "seconds": round(seconds, 6)}
+                   for name, (calls, seconds) in sorted(timers.items())},
+    }
+    if samples:
+        functions = collections.Counter()
+        for stack, hits in samples.items():
+            functions[stack.rsplit(";", 1)[-1]] += hits
+        data["profile"] = {
+            "interval_seconds": sample_interval,
+            "samples": sum(samples.values()),
+            "top_functions": functions.most_common(top),
+            "top_stacks": samples.most_common(top),
+        }
+    return data
+
+def prometheus_label(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+def prometheus_text():
+    """Counters and timers in the Prometheus text exposition format"""
+    lines = []
+    by_name = collections.defaultdict(list)
+    for (name, labels), value in sorted(counters.items()):
+        by_name[name].append((labels, value))
+    for name, values in by_name.items():
+        metric = f"{PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.extend(f"{metric}{prometheus_label(labels)} {value}" for labels, value in values)
+    if timers:
+        metric = f"{PREFIX}_duration_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        for name, (calls, seconds) in sorted(timers.items()):
+            label = prometheus_label((("timer", name),))
+            lines.append(f"{metric}_sum{label} {seconds:.6f}")
+            lines.append(f"{metric}_count{label} {calls}")
+    return "\n".join(lines) + "\n"
+
+def dump(path):
+    """Writes the metrics to path: Prometheus text for a .prom file, JSON otherwise"""
+    with open(path, "w", encoding="utf-8") as file:
+        if path.endswith(".prom"):
+            file.write(prometheus_text())
+        else:
+            json.dump(report(), file, indent=2)
+
+def configure_from_env():
+    """Enables metrics when BEARDOWN_METRICS names a file; returns that path (or None)"""
+    path = os.environ.get(METRICS_ENV)
+    if path:
+        enable()
+    return path
@@ -0,0 +1,360 @@
+"""
+MLLP (Minimal Lower Layer Protocol) transport for real-time HL7 feeds.
+
+Each message on the wire is framed as <VT> message <FS><CR> (0x0b ...
+0x1c 0x0d) and answered with an ACK whose MSA segment carries AA (accepted),
+AE (error) or AR (rejected) and the control ID of the message.
+
+MLLPServer accepts any number of concurrent connections. A received message
+is passed to a handler (dict_creator's de-identification), and the result
+is put on a bounded queue that a single task drains into a sink: a file or
+a downstream MLLP endpoint. The sender is ACKed once its message has been
+delivered, so a slow sink fills the queue, stops the server reading from
+its connections and pushes back on the senders through TCP.
+
+The command line offers a loopback stand-in for both ends of an interface:
+'receive' ACKs every message and appends it to a file, 'send' pushes the
+messages of a file over one or more connections.
+"""
+import argparse
+import asyncio
+import collections
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import hl7_tokenizer
+import message_index
+import metrics
+
+START_BLOCK = b"\x0b"
+END_BLOCK = b"\x1c\x0d"
+ENCODING = "utf-8"
+
+# Largest frame accepted from a connection
+MAX_MESSAGE_SIZE = 16 * 2**20
+
+# De-identified messages waiting for the sink; senders wait when it is full
+QUEUE_SIZE = 1000
+# Most messages handed to the sink at once
+SINK_BATCH = 256
+
+class FramingError(ValueError):
+    """The peer sent bytes that are not an MLLP frame"""
+
+class DeliveryError(RuntimeError):
+    """
+    The downstream endpoint did not accept a message. delivered is the
+    number of messages of the batch accepted before it.
+    """
+
+    def __init__(self, text, delivered=0):
+        super().__init__(text)
+        self.delivered = delivered
+
+def parse_address(text, default_host="127.0.0.1"):
+    """(host, port) of 'host:port' or 'port'"""
+    host, _, port = text.rpartition(":")
+    return host or default_host, int(port)
+
+def frame(message):
+    """MLLP frame of one message (segments separated by '\\r')"""
+    return START_BLOCK + message.encode(ENCODING) + END_BLOCK
+
+async def read_frame(reader):
+    """Payload of the next frame from reader; None at the end of the stream"""
+    try:
+        data = await reader.readuntil(END_BLOCK)
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise FramingError("Connection closed inside a frame") from None
+        return None
+    except asyncio.LimitOverrunError:
+        raise FramingError(f"Frame larger than {MAX_MESSAGE_SIZE} bytes") from None
+    start = data.find(START_BLOCK)
+    if start == -1:
+        raise FramingError("Frame without a start block")
+    return data[start + 1:-len(END_BLOCK)]
+
+def ack(message, code="AA", text=""):
+    """
+    ACK of message with MSA-1 code: sender and receiver of the MSH are
+    swapped, and MSA-2 echoes the control ID (MSH-10).
+    """
+    field = hl7_tokenizer.header_field(message, 1) or "|"
+    encoding = hl7_tokenizer.header_field(message, 2) or "^~\\&"
+    header = {index: hl7_tokenizer.header_field(message, index) for index in (3, 4, 5, 6, 9, 10, 11, 12)}
+    trigger = header[9].split(encoding[0])[1] if encoding[0] in header[9] else ""
+    for separator in (field, encoding, "\r", "\n"):
+        for character in separator:
+            text = text.replace(character, " ")
+    msh = field.join([
+        "MSH", encoding, header[5], header[6], header[3], header[4],
+        datetime.now().strftime("%Y%m%d%H%M%S"), "", f"ACK{encoding[0]}{trigger}" if trigger else "ACK",
+        header[10], header[11] or "P", header[12] or "2.5",
+    ])
+    msa = field.join(["MSA", code, header[10], text] if text else ["MSA", code, header[10]])
+    return msh + "\r" + msa
+
+def ack_code(reply):
+    """MSA-1 of an ACK ('' when it has none)"""
+    return hl7_tokenizer.parse(reply).get("MSA", 1).strip()
+
+class FileSink:
+    """Appends messages to a file, one per line as dict_creator writes them"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a", encoding=ENCODING)
+
+    async def send(self, messages):
+        self.file.write("".join(message + "\n" for message in messages))
+        self.file.flush()
+
+    async def close(self):
+        self.file.close()
+
+class MLLPForwarder:
+    """
+    Sends messages to a downstream MLLP endpoint over one connection, in
+    order, waiting for the ACK of each. A dropped connection is reopened
+    once per message, so a message may be delivered twice but never lost
+    silently.
+    """
+
+    def __init__(self, host, port, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, limit=MAX_MESSAGE_SIZE), self.timeout)
+
+    async def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        self.reader = self.writer = None
+
+    async def deliver(self, message):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(frame(message))
+        await self.writer.drain()
+        reply = await asyncio.wait_for(read_frame(self.reader), self.timeout)
+        if reply is None:
+            raise ConnectionResetError("Downstream closed the connection")
+        return ack_code(reply.decode(ENCODING, "replace"))
+
+    async def send(self, messages):
+        """Delivers messages in order; raises DeliveryError at the first one not accepted"""
+        for index, message in enumerate(messages):
+            try:
+                code = await self.deliver(message)
+            except (OSError, asyncio.TimeoutError, FramingError):
+                await self.disconnect()
+                try:
+                    code = await self.deliver(message)
+                except (OSError, asyncio.TimeoutError, FramingError) as e:
+                    await self.disconnect()
+                    raise DeliveryError(f"Downstream unreachable: {e or type(e).__name__}", index) from e
+            if code not in ("AA", "CA"):
+                raise DeliveryError(f"Downstream answered {code or 'without an MSA'}", index)
+
+    async def close(self):
+        await self.disconnect()
+
+class MLLPServer:
+    """
+    MLLP listener. handler(message) returns the message to forward.
+    handler and persist() run in a single worker thread, one call at a time,
+    so they may share state without locks while the event loop stays free
+    for the connections and the sink. persist() is called every
+    persist_interval seconds while messages arrive, and once more on close.
+    """
+
+    def __init__(self, handler, sink, queue_size=QUEUE_SIZE, persist=None, persist_interval=60.0):
+        self.handler = handler
+        self.sink = sink
+        self.queue = asyncio.Queue(queue_size)
+        self.persist = persist
+        self.persist_interval = persist_interval
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.server = None
+        self.tasks = []
+        self.writers = set()
+        self.handled = 0
+        self.persisted = 0
+
+    async def start(self, host, port):
+        """Starts listening; returns the port (useful with port 0)"""
+        self.server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_MESSAGE_SIZE)
+        self.tasks.append(asyncio.create_task(self.forward()))
+        if self.persist is not None:
+            self.tasks.append(asyncio.create_task(self.persist_periodically()))
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle_connection(self, reader, writer):
+        self.writers.add(writer)
+        metrics.count("mllp_connections")
+        try:
+            while True:
+                data = await read_frame(reader)
+                if data is None:
+                    break
+                reply = await self.process(data)
+                writer.write(frame(reply))
+                await writer.drain()
+        except FramingError:
+            metrics.count("mllp_framing_errors")
+        except ConnectionError:
+            metrics.count("mllp_connection_errors")
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def process(self, data):
+        """De-identifies and forwards one received frame; returns the ACK"""
+        metrics.count("mllp_messages_received")
+        try:
+            message = message_index.normalize_message(data.decode(ENCODING))
+        except UnicodeDecodeError:
+            return self.reply("", "AR", f"Message is not {ENCODING}")
+        if not message.startswith("MSH"):
+            return self.reply(message, "AR", "Message does not start with an MSH segment")
+        try:
+            deidentified = await asyncio.get_running_loop().run_in_executor(self.executor, self.handler, message)
+        except Exception as e:
+            return self.reply(message, "AE", f"De-identification failed: {e}")
+        self.handled += 1
+        delivered = asyncio.get_running_loop().create_future()
+        await self.queue.put((deidentified, delivered))
+        try:
+            await delivered
+        except Exception as e:
+            return self.reply(message, "AE", f"Not forwarded: {e}")
+        return self.reply(message, "AA")
+
+    def reply(self, message, code, text=""):
+        metrics.count("mllp_acks", code=code)
+        return ack(message, code, text)
+
+    async def forward(self):
+        """Drains the queue into the sink, a batch at a time"""
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < SINK_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            error = None
+            try:
+                await self.sink.send([message for message, _ in batch])
+                accepted = len(batch)
+            except Exception as e:
+                # Only the messages after the last one accepted are answered with AE
+                error = e
+                accepted = getattr(e, "delivered", 0)
+                metrics.count("mllp_forward_errors", len(batch) - accepted)
+            metrics.count("mllp_messages_forwarded", accepted)
+            for index, (_, delivered) in enumerate(batch):
+                if not delivered.done():
+                    if index < accepted:
+                        delivered.set_result(None)
+                    else:
+                        delivered.set_exception(error)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def persist_now(self):
+        if self.persist is not None and self.handled != self.persisted:
+            handled = self.handled
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.persist)
+            self.persisted = handled
+
+    async def persist_periodically(self):
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            await self.persist_now()
+
+    async def close(self):
+        """Stops listening, delivers what is queued, persists and closes the sink"""
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.persist_now()
+        self.executor.shutdown()
+        await self.sink.close()
+
+    async def serve(self, host, port):
+        """Serves until SIGINT or SIGTERM, then closes cleanly"""
+        port = await self.start(host, port)
+        print(f"Listening for MLLP on {host}:{port}")
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        await self.close()
+
+async def send_messages(host, port, messages):
+    """Sends messages over one connection, one at a time; returns their ACK codes"""
+    reader, writer = await asyncio.open_connection(host, port, limit=MAX_MESSAGE_SIZE)
+    codes = []
+    try:
+        for message in messages:
+            writer.write(frame(message))
+            await writer.drain()
+            reply = await read_frame(reader)
+            if reply is None:
+                raise ConnectionResetError("Server closed the connection")
+            codes.append(ack_code(reply.decode(ENCODING, "replace")))
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    return codes
+
+async def send_file(host, port, path, connections=1):
+    """Sends the messages of path round-robin over connections; returns the ACK code counts"""
+    messages = list(message_index.iter_messages(path))
+    results = await asyncio.gather(*(send_messages(host, port, messages[start::connections])
+                                     for start in range(connections)))
+    return collections.Counter(code for codes in results for code in codes), len(messages)
+
+def main():
+    parser = argparse.ArgumentParser(description="MLLP loopback stand-ins for testing the de-identification server")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    receive_parser = subparsers.add_parser("receive", help="downstream stand-in: ACK and append messages to a file")
+    receive_parser.add_argument("port", type=int)
+    receive_parser.add_argument("--host", default="127.0.0.1")
+    receive_parser.add_argument("--output", default="received.txt")
+
+    send_parser = subparsers.add_parser("send", help="interface engine stand-in: send the messages of a file")
+    send_parser.add_argument("port", type=int)
+    send_parser.add_argument("input_file", nargs="?", default="raw.txt")
+    send_parser.add_argument("--host", default="127.0.0.1")
+    send_parser.add_argument("--connections", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "receive":
+        asyncio.run(MLLPServer(lambda message: message, FileSink(args.output)).serve(args.host, args.port))
+    else:
+        start = time.perf_counter()
+        codes, count = asyncio.run(send_file(args.host, args.port, args.input_file, args.connections))
+        elapsed = time.perf_counter() - start
+        print(f"Sent {count} messages over {args.connections} connection(s) in {elapsed:.2f} s "
+              f"({count / elapsed:.0f} msg/s): " + ", ".join(f"{n} {code}" for code, n in sorted(codes.items())))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import json
+import sqlite3
+from collections.abc import MutableMapping
+
+# All mappings live in one indexed table, one namespace per mapping:
+#   patient   patient key -> patient record (real and fake values)
+#   mrn, ssn, name_dob   identifier -> patient key (the patient index)
+#   gt1_nk1   GT1/NK1 name field -> [fake last name, fake first name]
+#   doctor    PV1 doctor field -> doctor pseudonym
+#   generator RandomGenerator sequence state (seed and position) per value space
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mappings (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID
+"""
+
+class StoredMapping(MutableMapping):
+    """
+    dict-like view of one namespace of the store. Rows are loaded on first
+    access and cached; every cached row is written back on flush, so records
+    changed in place (e.g. merged patient data) are persisted as well.
+    """
+
+    def __init__(self, conn, namespace):
+        self.conn = conn
+        self.namespace = namespace
+        self.cache = {}
+
+    def __getitem__(self, key):
+        if key in self.cache:
+            return self.cache[key]
+        row = self.conn.execute(
+            "SELECT value FROM mappings WHERE namespace = ? AND key = ?",
+            (self.namespace, key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        value = json.loads(row[0])
+        self.cache[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+
+    def __delitem__(self, key):
+        self[key]  # raises KeyError for unknown keys
+        self.cache.pop(key, None)
+        self.conn.execute("DELETE FROM mappings WHERE namespace = ? AND key = ?",
+                          (self.namespace, key))
+
+    def __iter__(self):
+        self.flush()
+        cursor = self.conn.execute("SELECT key FROM mappings WHERE namespace = ?", (self.namespace,))
+        for (key,) in cursor:
+            yield key
+
+    def __len__(self):
+        self.flush()
+        return self.conn.execute("SELECT COUNT(*) FROM mappings WHERE namespace = ?",
+                                 (self.namespace,)).fetchone()[0]
+
+    def touched(self):
+        """Keys read or written since the store was opened"""
+        return list(self.cache)
+
+    def flush(self):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO mappings (namespace, key, value) VALUES (?, ?, ?)",
+            ((self.namespace, key, json.dumps(value)) for key, value in self.cache.items()))
+
+class PatientStore:
+    """
+    On-disk pseudonym store shared across runs. Only the patients, names and
+    doctors a run actually touches are loaded; new ones are appended on flush.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The MLLP server uses the store from its worker thread; it is only ever
+        # used by one thread at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(SCHEMA)
+        self.patient_dict = StoredMapping(self.conn, "patient")
+        self.patient_index = {
+            "mrn": StoredMapping(self.conn, "mrn"),
+            "ssn": StoredMapping(self.conn, "ssn"),
+            "name_dob": StoredMapping(self.conn, "name_dob"),
+        }
+        self.gt1_nk1_dict = StoredMapping(self.conn, "gt1_nk1")
+        self.doctor_dict = StoredMapping(self.conn, "doctor")
+        self.generator_state = StoredMapping(self.conn, "generator")
+
+    def mappings(self):
+        return [self.patient_dict, *self.patient_index.values(), self.gt1_nk1_dict,
+                self.doctor_dict, self.generator_state]
+
+    def flush(self):
+        """Writes all loaded and new rows in one transaction"""
+        with self.conn:
+            for mapping in self.mappings():
+                mapping.flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
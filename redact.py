@@ -1,130 +1,273 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
 import re
+import hl7_tokenizer
+import message_index
+
+# Redaction rules: whole fields per segment type and free-text patterns per field
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "redact_rules.json")
+
+# Input is redacted in chunks of about this many bytes, split at MSH boundaries
+CHUNK_SIZE = 4 * 2**20
+
+# Output is written through a large buffer
+WRITE_BUFFER_SIZE = 2**20
+
+# Compiled rule combinations kept per rule set
+MATCHER_CACHE_SIZE = 4096
+
+class TextRule:
+    """
+    Free-text rule for one field: replaces pattern with '*' in the components
+    matching the optional 'when' regex ('(?i)' prefix for any case). A
+    "full_name" rule matches the patient's "first last" name from PID-5.
+    """
+    __slots__ = ('pattern', 'when', 'when_text', 'ignore_case', 'needs_name')
+
+    def __init__(self, config):
+        self.needs_name = config.get('match') == 'full_name'
+        self.pattern = None if self.needs_name else config['pattern']
+        when = config.get('when') or None
+        self.ignore_case = when is not None and when.startswith('(?i)')
+        if self.ignore_case:
+            when = when[4:]
+        self.when_text = None
+        self.when = None
+        if when is not None and re.escape(when).replace('\\ ', ' ') == when:
+            # Plain words are tested with 'in', which is far cheaper than a regex search
+            self.when_text = when.lower() if self.ignore_case else when
+        elif when is not None:
+            self.when = re.compile(when, re.IGNORECASE if self.ignore_case else 0)
+
+    def applies(self, text, full_name):
+        if self.needs_name:
+            return full_name is not None and full_name in text
+        if self.when_text is not None:
+            return self.when_text in (text.lower() if self.ignore_case else text)
+        return self.when is None or self.when.search(text) is not None
+
+class SegmentPlan:
+    """
+    Rules of one segment type: fields redacted whole and free-text rules by
+    field. A line of a segment without whole-field redaction is split only
+    if the condition of one of its rules occurs somewhere in it.
+    """
+    __slots__ = ('redact_fields', 'text_rules', 'needs_name', 'prefilter', 'words', 'words_ignore_case', 'patterns')
+
+    def __init__(self, redact_fields, text_rules):
+        self.redact_fields = tuple(sorted(redact_fields))
+        self.text_rules = tuple(text_rules.items())
+        rules = [rule for field_rules in text_rules.values() for rule in field_rules]
+        self.needs_name = any(rule.needs_name for rule in rules)
+        conditional = [rule for rule in rules if not rule.needs_name]
+        self.prefilter = not self.redact_fields and all(rule.when_text or rule.when for rule in conditional)
+        self.words = [rule.when_text for rule in conditional if rule.when_text and not rule.ignore_case]
+        self.words_ignore_case = [rule.when_text for rule in conditional if rule.when_text and rule.ignore_case]
+        self.patterns = [rule.when for rule in conditional if rule.when]
+
+    def triggered(self, line, full_name):
+        """False when no rule can apply anywhere in the line (only used with prefilter set)"""
+        if full_name is not None and full_name in line:
+            return True
+        for word in self.words:
+            if word in line:
+                return True
+        if self.words_ignore_case:
+            lower = line.lower()
+            for word in self.words_ignore_case:
+                if word in lower:
+                    return True
+        for pattern in self.patterns:
+            if pattern.search(line):
+                return True
+        return False
+
+class RedactionRules:
+    """Rules loaded from the config file, compiled into one plan per segment type"""
+
+    def __init__(self, config):
+        redact_fields = config.get('redact_fields', {})
+        text_rules = {}
+        for rule in config.get('text_rules', []):
+            text_rules.setdefault(rule['segment'], {}).setdefault(rule['field'], []).append(TextRule(rule))
+        self.plans = {segment: SegmentPlan(redact_fields.get(segment, ()), text_rules.get(segment, {}))
+                      for segment in set(redact_fields) | set(text_rules)}
+        self.matchers = {}
+
+    def matcher(self, rules, full_name):
+        """
+        One compiled alternation of the given rules; at each position the
+        rules are tried in config order. Compiled once per rule combination
+        (and patient name, for name rules).
+        """
+        key = (rules, full_name)
+        matcher = self.matchers.get(key)
+        if matcher is None:
+            if len(self.matchers) >= MATCHER_CACHE_SIZE:
+                self.matchers.clear()
+            matcher = self.matchers[key] = re.compile('|'.join(
+                re.escape(full_name) if rule.needs_name else f'(?:{rule.pattern})' for rule in rules))
+        return matcher
+
+    def substitute(self, text, active, full_name):
+        """Replaces every match of the active rules with '*' in a single pass"""
+        if len(active) == 1 and active[0].needs_name:
+            return text.replace(full_name, '*')
+        name = full_name if any(rule.needs_name for rule in active) else None
+        return self.matcher(tuple(active), name).sub('*', text)
+
+    def redact_text(self, value, rules, full_name):
+        """Applies a field's text rules to each component their condition holds for"""
+        # A condition that fails for the whole field fails for every component
+        active = [rule for rule in rules if rule.applies(value, full_name)]
+        if not active:
+            return value
+        if '^' not in value:
+            return self.substitute(value, active, full_name)
+        components = value.split('^')
+        for index, component in enumerate(components):
+            component_rules = [rule for rule in active if rule.applies(component, full_name)]
+            if component_rules:
+                components[index] = self.substitute(component, component_rules, full_name)
+        return '^'.join(components)
+
+def load_rules(path=RULES_FILE):
+    with open(path, encoding='utf-8') as file:
+        return RedactionRules(json.load(file))
+
+# Rules of RULES_FILE, loaded on first use
+default_rules = None
+
+def get_default_rules():
+    global default_rules
+    if default_rules is None:
+        default_rules = load_rules()
+    return default_rules
+
+def redact_components(field):
+    """Every non-empty component becomes '*', empty ones are kept"""
+    if '^' not in field:
+        return '*'
+    return '^'.join(['*' if component else '' for component in field.split('^')])
+
+def redact_hl7_line(line, first_name, last_name, rules=None):
+    if rules is None:
+        rules = get_default_rules()
+    plan = rules.plans.get(line[:line.find('|')] if '|' in line else line)
+    if plan is None:
+        return line
+    full_name = f"{first_name} {last_name}" if plan.needs_name and first_name and last_name else None
+    if plan.prefilter and not plan.triggered(line, full_name):
+        return line
 
-def redact_hl7_line(line, first_name, last_name):
     temp = line.split('|')
-    
-    sensitive_indices = {
-        'PID': [2, 3, 4, 5, 6, 7, 9, 11, 12, 13, 14, 18, 19, 20, 21, 29, 30, 31],  
-        'NK1': [2, 3, 4, 5, 6, 7, 8, 10, 12, 16, 26, 30, 31, 32, 33, 37],  
-        'PV1': [5, 7, 8, 9, 17, 19, 50, 52],  
-        'EVN': [5],  
-    }
-
-    segment_type = temp[0]
-
-    if segment_type in sensitive_indices:
-        for i in sensitive_indices[segment_type]:
-            if i < len(temp) and temp[i]:  # Check if field exists and is not empty
-                # Split by caret and preserve them, redacting components
-                components = temp[i].split('^')
-                redacted_components = []
-                for comp in components:
-                    if comp:  # Only redact non-empty components
-                        redacted_components.append('*')
-                    else:
-                        redacted_components.append('')  # Preserve empty components
-                temp[i] = '^'.join(redacted_components)
-
-    # Handle OBX comments
-    if len(temp) > 5 and segment_type == 'OBX':
-        text_to_redact = temp[5]
-        if first_name and last_name:
-            full_name = f"{first_name} {last_name}"
-            if full_name in text_to_redact:
-                # Preserve carets while redacting around them
-                components = text_to_redact.split('^')
-                redacted_components = []
-                for comp in components:
-                    if full_name in comp:
-                        redacted_components.append(comp.replace(full_name, '*'))
-                    else:
-                        redacted_components.append(comp)
-                text_to_redact = '^'.join(redacted_components)
-        temp[5] = text_to_redact
-
-    # Handle NTE comments
-    if len(temp) > 2 and segment_type == 'NTE':
-        text_to_redact = temp[2]
-        
-        # Handle SSN
-        if "ID" in text_to_redact:
-            components = text_to_redact.split('^')
-            redacted_components = []
-            for comp in components:
-                if "ID" in comp:
-                    redacted_comp = re.sub(r'[0-9]', '*', comp)
-                    redacted_components.append(redacted_comp)
-                else:
-                    redacted_components.append(comp)
-            text_to_redact = '^'.join(redacted_components)
-
-        # Handle birthdates
-        if "birthdate" in text_to_redact.lower():
-            components = text_to_redact.split('^')
-            redacted_components = []
-            for comp in components:
-                if "birthdate" in comp.lower():
-                    redacted_comp = re.sub(r'\b(January|February|March|April|May|June|July|August|September|October|November|December)\s+\d{1,2},\s+\d{4}\b', '*', comp)
-                    redacted_components.append(redacted_comp)
-                else:
-                    redacted_components.append(comp)
-            text_to_redact = '^'.join(redacted_components)
-
-        # Handle 'cinco de mayo'
-        if "cinco de mayo" in text_to_redact.lower():
-            components = text_to_redact.split('^')
-            redacted_components = []
-            for comp in components:
-                if "cinco de mayo" in comp.lower():
-                    redacted_comp = re.sub(r'cinco de mayo', '*', comp, flags=re.IGNORECASE)
-                    redacted_components.append(redacted_comp)
-                else:
-                    redacted_components.append(comp)
-            text_to_redact = '^'.join(redacted_components)
-
-        temp[2] = text_to_redact
-
-    if len(temp) > 3 and segment_type == 'NTE':
-        text_to_redact = temp[3]
-        if "ID" in text_to_redact:
-            components = text_to_redact.split('^')
-            redacted_components = []
-            for comp in components:
-                if "ID" in comp:
-                    redacted_comp = re.sub(r'\d{3}-\d{2}-\d{4}', '*', comp)
-                    redacted_components.append(redacted_comp)
-                else:
-                    redacted_components.append(comp)
-            text_to_redact = '^'.join(redacted_components)
-        temp[3] = text_to_redact
+    for i in plan.redact_fields:
+        if i < len(temp) and temp[i]:  # Check if field exists and is not empty
+            temp[i] = redact_components(temp[i])
+
+    for i, field_rules in plan.text_rules:
+        if i < len(temp) and temp[i]:
+            temp[i] = rules.redact_text(temp[i], field_rules, full_name)
 
     redacted_line = '|'.join(temp)
     return redacted_line
 
-def redact_hl7_file(input_file, output_file):
+def redact_lines(lines, rules=None):
+    """
+    Yields the redacted output line (with newline) of every input line. The
+    PID-5 name of the current message is carried from its PID segment to
+    the following segments and reset at each MSH.
+    """
     first_name = None
     last_name = None
-    with open(input_file, "r") as inFile, open(output_file, "w") as outFile:
-        for line in inFile:
-            line = line.rstrip()
-            
-            if line.startswith("MSH"):
-                first_name = None
-                last_name = None
-
-            if line.startswith("PID"):
-                temp = line.split('|')
-                if len(temp) > 5:
-                    name_parts = temp[5].split('^') 
-                    if len(name_parts) > 1:
-                        first_name = name_parts[1]
-                        last_name = name_parts[0]
-
-            if line.strip():
-                redacted_line = redact_hl7_line(line, first_name, last_name)
-                outFile.write(redacted_line + "\n")
-            else:
-                outFile.write("\n")
-
-# Usage
-redact_hl7_file("raw.txt", "messages_redacted.txt")
+    for line in lines:
+        line = line.rstrip()
+
+        if line.startswith("MSH"):
+            first_name = None
+            last_name = None
+
+        if line.startswith("PID"):
+            segment = hl7_tokenizer.Segment(line, hl7_tokenizer.DEFAULT_SEPARATORS)
+            if len(segment) > 5:
+                name_parts = segment.components(5)
+                if len(name_parts) > 1:
+                    first_name = name_parts[1]
+                    last_name = name_parts[0]
+
+        if line.strip():
+            yield redact_hl7_line(line, first_name, last_name, rules) + "\n"
+        else:
+            yield "\n"
+
+def chunk_ranges(input_file, chunk_size):
+    """
+    Byte ranges of roughly chunk_size bytes covering the whole file, split
+    only where a line starts with 'MSH|', so no message spans two chunks.
+    """
+    with message_index.MessageIndex(input_file) as index:
+        size = index.size
+        boundaries = [offset for offset in index.offsets if offset > 0]
+    ranges = []
+    start = 0
+    for boundary in boundaries:
+        if boundary - start >= chunk_size:
+            ranges.append((start, boundary))
+            start = boundary
+    if start < size or not ranges:
+        ranges.append((start, size))
+    return ranges
+
+def redact_range(input_file, start, end, rules=None):
+    """Redacted text of bytes start:end of the file (a whole number of messages)"""
+    with open(input_file, "rb") as file:
+        file.seek(start)
+        text = file.read(end - start).decode("utf-8")
+    # Same line splitting as reading the file in text mode: \r, \n and \r\n
+    return "".join(redact_lines(io.StringIO(text, newline=None), rules))
+
+def init_redact_worker(rules_file):
+    global default_rules
+    default_rules = load_rules(rules_file)
+
+def redact_range_task(task):
+    return redact_range(*task)
+
+def redact_hl7_file(input_file, output_file, workers=1, chunk_size=CHUNK_SIZE, rules_file=RULES_FILE):
+    """
+    Redacts input_file into output_file. The file is split into chunks at
+    MSH boundaries; with workers > 1 the chunks are redacted by a process
+    pool and written in input order, so the output does not depend on the
+    number of workers.
+    """
+    ranges = chunk_ranges(input_file, chunk_size)
+    with open(output_file, "w", buffering=WRITE_BUFFER_SIZE) as outFile:
+        if workers > 1:
+            tasks = [(input_file, start, end) for start, end in ranges]
+            with multiprocessing.Pool(workers, initializer=init_redact_worker, initargs=(rules_file,)) as pool:
+                for text in pool.imap(redact_range_task, tasks):
+                    outFile.write(text)
+        else:
+            rules = load_rules(rules_file)
+            for start, end in ranges:
+                outFile.write(redact_range(input_file, start, end, rules))
+    return len(ranges)
+
+def main():
+    parser = argparse.ArgumentParser(description="Redact sensitive fields and free text in an HL7 file")
+    parser.add_argument("input", nargs="?", default="raw.txt")
+    parser.add_argument("output", nargs="?", default="messages_redacted.txt")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes")
+    parser.add_argument("--chunk-mb", type=float, default=CHUNK_SIZE / 2**20,
+                        help="approximate size of the chunks handed to the workers")
+    parser.add_argument("--rules", default=RULES_FILE, help="redaction rules file")
+    args = parser.parse_args()
+
+    chunks = redact_hl7_file(args.input, args.output, args.workers, int(args.chunk_mb * 2**20), args.rules)
+    print(f"Redacted {args.input} into {args.output} ({chunks} chunks)")
+
+if __name__ == "__main__":
+    main()
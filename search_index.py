@@ -0,0 +1,218 @@
+"""
+Inverted substring index for the viewer's search boxes.
+
+Every searchable string (a distinct column value, or a word of a message
+body) is stored once in a vocabulary, packed into one byte buffer. The
+suffixes of the vocabulary are sorted by their first bytes, kept as
+integer keys, so a substring query is two binary searches; a postings
+table maps each vocabulary entry to the rows it occurs in. A query touches
+only the matching entries and their rows, whatever the size of the table.
+"""
+import itertools
+import re
+
+import numpy as np
+import pandas as pd
+
+# Suffixes are sorted by their first SUFFIX_BYTES bytes, packed into one
+# uint64 key; longer queries are verified against the full value
+SUFFIX_BYTES = 8
+
+# Suffix keys are computed this many suffixes at a time to bound memory
+KEY_CHUNK = 2**18
+
+# Above this many matching entries, rows are collected with one vectorized
+# pass over the postings instead of one slice per entry
+GATHER_LIMIT = 64
+
+# Message bodies are indexed word by word; separators are not searchable
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+EMPTY_ROWS = np.zeros(0, dtype=np.int64)
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class SuffixIndex:
+    """
+    Suffix array over a list of distinct lowercase strings. The strings are
+    stored NUL-terminated in one buffer, and each suffix is represented by
+    its sort key (first SUFFIX_BYTES bytes, big-endian, zero-padded at the
+    end of its string) and the id of its string: 12 bytes per suffix and no
+    per-suffix Python objects.
+    """
+
+    def __init__(self, values):
+        text = "\0".join(value.replace("\0", "") for value in values)
+        self.buffer = text.encode("utf-8") + b"\0"
+        data = np.frombuffer(self.buffer, dtype=np.uint8)
+        ends = np.flatnonzero(data == 0)
+        self.size = len(ends) if len(values) else 0
+        # String n is buffer[starts[n]:starts[n + 1] - 1]
+        self.starts = np.concatenate(([0], ends + 1)).astype(np.int64)
+        offsets = np.flatnonzero(data).astype(np.int32 if len(data) < 2**31 else np.int64)
+        padded = np.concatenate((data, np.zeros(SUFFIX_BYTES, dtype=np.uint8)))
+        window = np.arange(SUFFIX_BYTES, dtype=np.int32)
+        keys = np.empty(len(offsets), dtype=np.uint64)
+        for start in range(0, len(offsets), KEY_CHUNK):
+            chunk = offsets[start:start + KEY_CHUNK]
+            prefix = padded[chunk[:, None] + window]
+            # Bytes past the end of the string (its NUL and the next string) read as zero
+            prefix *= np.cumprod(prefix != 0, axis=1, dtype=np.uint8)
+            keys[start:start + len(chunk)] = prefix.view(">u8").ravel()
+        del offsets, padded
+        lengths = np.diff(self.starts)[:self.size] - 1
+        owners = np.repeat(np.arange(self.size, dtype=np.int32), lengths)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        del keys
+        self.owners = owners[order]
+
+    def __len__(self):
+        return self.size
+
+    def value(self, value_id):
+        return self.buffer[self.starts[value_id]:self.starts[value_id + 1] - 1]
+
+    def matching(self, query):
+        """Ids of the values containing query, in ascending order"""
+        query = query.encode("utf-8")
+        if not query:
+            return np.arange(self.size, dtype=np.int64)
+        if b"\0" in query:
+            return EMPTY_ROWS
+        prefix = query[:SUFFIX_BYTES]
+        lo = int.from_bytes(prefix.ljust(SUFFIX_BYTES, b"\0"), "big")
+        hi = int.from_bytes(prefix.ljust(SUFFIX_BYTES, b"\xff"), "big")
+        first = np.searchsorted(self.keys, np.uint64(lo), side="left")
+        last = np.searchsorted(self.keys, np.uint64(hi), side="right")
+        value_ids = np.unique(self.owners[first:last]).astype(np.int64)
+        if len(query) > len(prefix):
+            value_ids = np.array([i for i in value_ids if query in self.value(i)], dtype=np.int64)
+        return value_ids
+
+class PostingsIndex:
+    """
+    Suffix index of a vocabulary plus its postings: pair n says vocabulary
+    entry keys[n] occurs in row rows[n].
+    """
+
+    def __init__(self, vocabulary, keys, rows, row_count):
+        self.vocabulary = SuffixIndex(vocabulary)
+        self.row_count = row_count
+        self.keys = keys
+        self.rows = rows
+        # Pairs grouped by entry: the pairs of entry k are order[starts[k]:starts[k + 1]]
+        self.order = np.argsort(keys, kind="stable").astype(np.int32)
+        self.starts = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=len(self.vocabulary)), out=self.starts[1:])
+
+    def search(self, query):
+        """Sorted, unique row ids of the entries containing query"""
+        value_ids = self.vocabulary.matching(query)
+        if not len(value_ids):
+            return EMPTY_ROWS
+        if len(value_ids) == 1:
+            pairs = self.order[self.starts[value_ids[0]]:self.starts[value_ids[0] + 1]]
+            return self.rows[pairs].astype(np.int64)
+        if len(value_ids) <= GATHER_LIMIT:
+            pairs = np.concatenate([self.order[self.starts[i]:self.starts[i + 1]] for i in value_ids])
+            matched_rows = self.rows[pairs]
+        else:
+            hit = np.zeros(len(self.vocabulary), dtype=bool)
+            hit[value_ids] = True
+            matched_rows = self.rows[hit[self.keys]]
+        # A row can be reached through several entries
+        row_mask = np.zeros(self.row_count, dtype=bool)
+        row_mask[matched_rows] = True
+        return np.flatnonzero(row_mask)
+
+def column_index(series):
+    """
+    Index of a column of short values (message ID, MRN, name). Takes a
+    categorical of lowercased values, so each distinct value is indexed once.
+    """
+    keys = series.cat.codes.to_numpy().astype(np.int32)
+    return PostingsIndex(series.cat.categories, keys, np.arange(len(keys), dtype=np.int32), len(keys))
+
+def text_index(texts, chunk_size=4096):
+    """Word index of free-text documents (one per row)"""
+    token_ids = {}
+    key_chunks = []
+    row_chunks = []
+    row_count = 0
+    chunk = []
+    for text in itertools.chain(texts, [None]):
+        if text is not None:
+            chunk.append(text)
+            if len(chunk) < chunk_size:
+                continue
+        if not chunk:
+            break
+        # Words of the chunk are numbered in bulk; only the chunk's distinct words go through the dict
+        words = []
+        counts = []
+        for document in chunk:
+            document_words = tokenize(document)
+            words.extend(document_words)
+            counts.append(len(document_words))
+        codes, uniques = pd.factorize(pd.Series(words, dtype=object))
+        word_ids = np.array([token_ids.setdefault(word, len(token_ids)) for word in uniques], dtype=np.int64)
+        rows = np.repeat(np.arange(row_count, row_count + len(chunk), dtype=np.int64), counts)
+        # A word repeated within a document is posted once
+        pairs = np.sort((word_ids[codes] << 32) | rows)
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))] if len(pairs) else pairs
+        key_chunks.append((pairs >> 32).astype(np.int32))
+        row_chunks.append((pairs & 0xFFFFFFFF).astype(np.int32))
+        row_count += len(chunk)
+        chunk = []
+    keys = np.concatenate(key_chunks) if key_chunks else np.zeros(0, dtype=np.int32)
+    rows = np.concatenate(row_chunks) if row_chunks else np.zeros(0, dtype=np.int32)
+    return PostingsIndex(token_ids, keys, rows, row_count)
+
+class MessageSearchIndex:
+    """
+    Search indexes of the viewer's table: one per searchable column plus an
+    optional word index over the message bodies (any iterable of texts, one
+    per row, so the bodies need not be kept in the table). The word index
+    can also be built later with text_index and passed to search. Queries
+    are case-insensitive substring matches; combined queries intersect the
+    row ids.
+    """
+
+    def __init__(self, df, columns, texts=None):
+        self.row_count = len(df)
+        self.columns = {column: column_index(df[key]) for column, key in columns.items()}
+        self.text = text_index(texts) if texts is not None else None
+
+    def search_column(self, column, query):
+        return self.columns[column].search(query.strip().lower())
+
+    def search_text(self, query, text=None):
+        """Rows whose body contains every word of query (as a substring of a word)"""
+        text = text if text is not None else self.text
+        rows = None
+        for token in tokenize(query):
+            token_rows = text.search(token)
+            rows = token_rows if rows is None else np.intersect1d(rows, token_rows, assume_unique=True)
+            if not len(rows):
+                break
+        return EMPTY_ROWS if rows is None else rows
+
+    def search(self, column_queries, text_query="", text=None):
+        """
+        Row ids matching every non-empty query, in ascending order. None when
+        no query is given (all rows match). text is the word index to use
+        instead of the one built with the table.
+        """
+        results = [self.search_column(column, query) for column, query in column_queries.items() if query.strip()]
+        text = text if text is not None else self.text
+        if text_query.strip() and text is not None:
+            results.append(self.search_text(text_query, text))
+        if not results:
+            return None
+        results.sort(key=len)
+        rows = results[0]
+        for other in results[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
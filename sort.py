@@ -1,69 +1,218 @@
-import hl7  
+import argparse
+import collections
+import heapq
+import struct
+import tempfile
+import hl7_tokenizer
+import message_index
+import metrics
 import re   
 
 # Function to parse HL7 messages from a file
 def parse_hl7_messages(file_path):
-    # Open the file
-    with open(file_path, 'r', encoding='utf-8') as file:
-        data = file.read()
-    
-    # Split the content by the 'MSH|' separator
-    messages = data.split('MSH|')
-    
-    # For each message, remove extra spaces, replace newline characters with carriage returns, and reattach 'MSH|' at the beginning
-    parsed_messages = ["MSH|" + msg.strip().replace('\n', '\r\n') + '\r' for msg in messages if msg.strip()]
+    # Index the message boundaries ('MSH|' at the start of a line) of the memory-mapped file
+    with message_index.MessageIndex(file_path) as index:
+        # For each message, remove extra spaces and end every segment with a carriage return + newline
+        parsed_messages = [msg.replace('\r', '\r\n') + '\r' for msg in index]
     
     # Return the list of parsed messages
     return parsed_messages
 
+# HL7 TS: YYYY[MM[DD[HH[MM[SS[.S[S[S[S]]]]]]]]][+/-ZZZZ]
+TIMESTAMP_PATTERN = re.compile(
+    r'(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?(?:\.(\d{1,4}))?(?:([+-])(\d{2})(\d{2}))?')
+
+# Key for messages whose timestamp cannot be read: sorted after all others
+FAILED_TIMESTAMP_KEY = 2 ** 62
+
+# Number of messages whose timestamp could not be read, by reason
+timestamp_failures = collections.Counter()
+
+# Function to count days since 1970-01-01 for a proleptic Gregorian date
+def days_from_civil(year, month, day):
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+# Function to get the number of days of a month of the proleptic Gregorian calendar
+def days_in_month(year, month):
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return 29
+    return DAYS_IN_MONTH[month - 1]
+
+# Function to turn an HL7 TS value into a comparable UTC integer
+def timestamp_to_key(timestamp, default_offset_minutes=0):
+    """
+    Normalizes any HL7 TS precision (YYYY up to YYYYMMDDHHMMSS.SSSS) and
+    +/-HHMM offset to UTC ten-thousandths of a second since 1970. Timestamps
+    without an offset are taken to be default_offset_minutes from UTC.
+    Returns None if the value is not a valid timestamp.
+    """
+    match = TIMESTAMP_PATTERN.fullmatch(timestamp)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, sign, offset_hours, offset_minutes = match.groups()
+    month = int(month) if month else 1
+    day = int(day) if day else 1
+    hour = int(hour) if hour else 0
+    minute = int(minute) if minute else 0
+    second = int(second) if second else 0
+    if not (1 <= month <= 12 and hour < 24 and minute < 60 and second < 61):
+        return None
+    # A day past the end of the month (20250231) is malformed, not a day of the next month
+    if not 1 <= day <= days_in_month(int(year), month):
+        return None
+    
+    if sign:
+        offset = int(offset_hours) * 60 + int(offset_minutes)
+        if sign == '-':
+            offset = -offset
+    else:
+        offset = default_offset_minutes
+    
+    seconds = (days_from_civil(int(year), month, day) * 86400 + hour * 3600 + (minute - offset) * 60 + second)
+    return seconds * 10000 + (int(fraction.ljust(4, '0')) if fraction else 0)
+
+# Function to build the sort key of an HL7 message from its MSH-7 timestamp
+def timestamp_key(hl7_message, default_offset_minutes=0):
+    """
+    Sort key of a message: its MSH-7 timestamp in UTC, read straight from the
+    header line. Unreadable timestamps are counted in timestamp_failures and
+    sort after every valid one.
+    """
+    timestamp = hl7_tokenizer.header_field(hl7_message, 7).split('^', 1)[0].strip()
+    if not timestamp:
+        timestamp_failures['missing'] += 1
+        return FAILED_TIMESTAMP_KEY
+    key = timestamp_to_key(timestamp, default_offset_minutes)
+    if key is None:
+        timestamp_failures['malformed'] += 1
+        return FAILED_TIMESTAMP_KEY
+    return key
+
 # Function to extract timestamp from an HL7 message
 def extract_timestamp(hl7_message):
-    try:
-        # Parse the HL7 message using the hl7 module
-        h = hl7.parse(hl7_message)
-        
-        # Extract the timestamp field 
-        timestamp_field = h[0][7]  
-
-        # If the timestamp is a hl7.Field object, extract its first value
-        if isinstance(timestamp_field, hl7.Field):
-            timestamp = str(timestamp_field[0]) 
-        else:
-            # Otherwise, directly convert it to a string
-            timestamp = str(timestamp_field)  
-        timestamp_without_timezone = timestamp
-        if "-" in timestamp:
-            timestamp_without_timezone = re.sub(r'[-+]\d{4}$', '', timestamp.strip())
-            integer_timestamp = int(timestamp_without_timezone)
-            integer_timestamp += 500
-            timestamp_without_timezone = str(integer_timestamp)
-        else:
-            timestamp_without_timezone = timestamp
-        # Remove the timezone information from the timestamp
-        # timestamp_without_timezone = re.sub(r'[-+]\d{4}$', '', timestamp.strip())
-        # Return the timestamp as an integer after stripping any unwanted characters
-        return int(timestamp_without_timezone) 
-    
-    except Exception as e:
-        print(f"Error parsing message: {e}")
-        return 99999999999999  
+    return timestamp_key(hl7_message)
 
 # Function to sort HL7 messages based on their timestamps
 def sort_hl7_messages(input_file, output_file):
     # Parse HL7 messages from the input file
     messages = parse_hl7_messages(input_file)
     
-    # Sort the messages by their timestamp using the extract_timestamp function as the sorting key
-    sorted_messages = sorted(messages, key=extract_timestamp)
+    # Sort the messages by their timestamp using the timestamp_key function as the sorting key
+    sorted_messages = sorted(messages, key=timestamp_key)
     
     # Write the sorted messages to the output file
     with open(output_file, 'w', encoding='utf-8') as file:
         file.write('\n'.join(sorted_messages))
 
-# Specify the input and output file paths
-input_file = 'raw2.txt'  
-output_file = 'messages_sorted.txt' 
+# Record layout of the sorted run files: timestamp key, input position, message length
+RUN_RECORD = struct.Struct('<qqI')
+
+# Function to write one sorted run to a temporary file
+def write_run(run, temp_dir):
+    run.sort()
+    with tempfile.NamedTemporaryFile('wb', dir=temp_dir, suffix='.run', delete=False) as file:
+        for key, position, message in run:
+            data = message.encode('utf-8')
+            file.write(RUN_RECORD.pack(key, position, len(data)))
+            file.write(data)
+    return file.name
+
+# Function to read back the records of a run file in order
+def read_run(path):
+    with open(path, 'rb') as file:
+        while True:
+            header = file.read(RUN_RECORD.size)
+            if not header:
+                break
+            key, position, length = RUN_RECORD.unpack(header)
+            yield key, position, file.read(length).decode('utf-8')
 
-sort_hl7_messages(input_file, output_file)
+# Function to sort HL7 messages larger than memory by their timestamps
+def external_sort_hl7_messages(input_file, output_file, memory_budget=256 * 1024 * 1024, temp_dir=None,
+                               default_offset_minutes=0):
+    """
+    Sorts the messages by MSH-7 timestamp in bounded memory: messages are
+    collected into runs of about memory_budget bytes, each run is sorted and
+    spilled to a temporary file, and the runs are k-way merged into the output.
+    Messages with equal timestamps keep their input order, so results are
+    reproducible. A feed that fits in one run is sorted without spilling.
+    Timestamps without a UTC offset are taken to be default_offset_minutes from UTC.
+    """
+    with tempfile.TemporaryDirectory(dir=temp_dir) as run_dir:
+        run_files = []
+        run = []
+        run_bytes = 0
+        message_count = 0
+        
+        build_timer = metrics.timer("sort_build_runs")
+        with build_timer, message_index.MessageIndex(input_file) as index:
+            for position, msg in enumerate(index):
+                message = msg.replace('\r', '\r\n') + '\r'
+                run.append((timestamp_key(message, default_offset_minutes), position, message))
+                # Count the text twice for the str object and sort bookkeeping overhead
+                run_bytes += 2 * len(message) + 100
+                message_count += 1
+                if run_bytes >= memory_budget:
+                    with metrics.timer("sort_spill_run"):
+                        run_files.append(write_run(run, run_dir))
+                    metrics.count("runs_spilled")
+                    run = []
+                    run_bytes = 0
+        
+        # Merge the spilled runs with the last (in-memory) run
+        run.sort()
+        runs = [read_run(path) for path in run_files] + [iter(run)]
+        
+        with metrics.timer("sort_merge"), open(output_file, 'w', encoding='utf-8') as file:
+            for count, (key, position, message) in enumerate(heapq.merge(*runs)):
+                if count:
+                    file.write('\n')
+                file.write(message)
+    
+    metrics.count("messages_sorted", message_count)
+    return message_count
 
-print(f"Sorted HL7 messages saved to {output_file}")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sort HL7 messages by their MSH-7 timestamp")
+    parser.add_argument('input_file', nargs='?', default='raw2.txt')
+    parser.add_argument('output_file', nargs='?', default='messages_sorted.txt')
+    parser.add_argument('--memory-mb', type=int, default=256,
+                        help="memory budget for the in-memory sort runs (default 256 MB)")
+    parser.add_argument('--temp-dir', help="directory for the temporary run files")
+    parser.add_argument('--default-offset', default='+0000',
+                        help="UTC offset (+/-HHMM) of timestamps that do not carry one (default +0000)")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="write run metrics to PATH: Prometheus text for .prom, else JSON")
+    args = parser.parse_args()
+    
+    offset_match = re.fullmatch(r'([+-])(\d{2})(\d{2})', args.default_offset)
+    if offset_match is None:
+        parser.error("--default-offset must look like +HHMM or -HHMM")
+    default_offset_minutes = int(offset_match.group(2)) * 60 + int(offset_match.group(3))
+    if offset_match.group(1) == '-':
+        default_offset_minutes = -default_offset_minutes
+    
+    # Specify the input and output file paths
+    input_file = args.input_file
+    output_file = args.output_file
+    if args.metrics:
+        metrics.enable()
+    
+    external_sort_hl7_messages(input_file, output_file, args.memory_mb * 1024 * 1024, args.temp_dir,
+                               default_offset_minutes)
+    
+    print(f"Sorted HL7 messages saved to {output_file}")
+    for reason, count in sorted(timestamp_failures.items()):
+        print(f"{count} message(s) with {reason} MSH-7 timestamp placed at the end")
+    
+    if args.metrics:
+        for reason, count in timestamp_failures.items():
+            metrics.count("timestamp_failures", count, reason=reason)
+        metrics.dump(args.metrics)
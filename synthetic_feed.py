@@ -0,0 +1,193 @@
+"""
+Synthetic HL7 feeds for benchmarks.
+
+Builds feeds of any size shaped like the real one: ADT/ORU messages with
+MSH, EVN, PID, PV1, optional NK1/GT1, vital-sign and free-text OBX and NTE
+segments. Names come from RandomGenerator's lists and names.txt. PID-3
+follows the layout of the message's HL7 version: a plain MRN for 2.1,
+HOST_VW identifiers for 2.4 (parse_identifiers24) and UAReg identifiers
+for 2.5 (parse_identifiers25). Patients return for repeat visits, and the
+MSH-7 timestamps are only roughly in order, so sorting has work to do.
+
+A patient's details are derived from the seed and the patient number, so
+feeds of millions of patients are generated without keeping them in memory.
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+import RandomGenerator as RG
+
+VERSIONS = ("2.1", "2.4", "2.5")
+
+MESSAGE_TYPES = ["ADT^A08", "ADT^A01", "ORU^R01", "ORM^O01"]
+FACILITIES = ["HOSP_WM", "HOSP_CBK", "HOSP_WS", "HOSP_SM"]
+
+# First MSH-7 timestamp; messages are about MESSAGE_INTERVAL apart and up
+# to TIMESTAMP_JITTER out of order
+START_TIME = datetime(2025, 1, 1)
+MESSAGE_INTERVAL = timedelta(seconds=30)
+TIMESTAMP_JITTER = 3600
+
+VITAL_SIGNS = [
+    ("ZBBO32^Heart Rate BPM:", lambda rng: str(rng.randint(45, 180))),
+    ("ZBB1^Temperature F:", lambda rng: f"{rng.uniform(96.0, 104.5):.1f}"),
+    ("AYYT888^Blood Pressure", lambda rng: f"{rng.randint(50, 99)}/{rng.randint(100, 180)}"),
+]
+
+# Free text mentioning the patient, as in the OBX/NTE comments of the real feed
+NOTES = [
+    "Scheduling MRI for {first} {last} to evaluate chronic headaches.",
+    "Suspecting possible UTI in {first} {last}, ordering urinalysis.",
+    "Patient {first} {last}, DOB {month}/{day}/{year}, reports dizziness since {visit}.",
+    "Blood pressure stable, follow up in 2 weeks.",
+    "ID {ssn} verified, birthdate {month_name} {day_number}, {year}.",
+    "Noted mild anemia in {first} {last}, suggesting dietary adjustments.",
+    "Heart rate 72 BPM, temperature 98.6 F.",
+    "Discussed lifestyle changes with {first} on {visit}.",
+]
+
+MONTH_NAMES = ["January", "February", "March", "April", "May", "June", "July",
+               "August", "September", "October", "November", "December"]
+
+def load_names(path=RG.NAMES_FILE):
+    """RandomGenerator's names plus the words of names.txt, lowercase as in PID-5"""
+    names = [name.lower() for name in RG.first_names + RG.last_names]
+    try:
+        with open(path, encoding="utf-8") as file:
+            names.extend(line.strip().lower() for line in file if line.strip())
+    except FileNotFoundError:
+        pass
+    return sorted(set(names))
+
+class FeedConfig:
+    """
+    Shape of a synthetic feed. repeat_ratio is the share of messages from a
+    patient seen before (while fewer than patients have been seen); the
+    segment ratios are per message.
+    """
+
+    def __init__(self, messages=10000, patients=None, repeat_ratio=0.5, versions=VERSIONS,
+                 obx=(3, 12), nte=(0, 4), nk1_ratio=0.3, gt1_ratio=0.2, doctors=200, seed=0):
+        self.messages = messages
+        self.patients = patients if patients is not None else max(1, messages // 2)
+        self.repeat_ratio = repeat_ratio
+        self.versions = tuple(versions)
+        self.obx = obx
+        self.nte = nte
+        self.nk1_ratio = nk1_ratio
+        self.gt1_ratio = gt1_ratio
+        self.doctors = doctors
+        self.seed = seed
+
+def make_patient(config, number, names):
+    """Real identity of patient number (the same every time for the same seed)"""
+    rng = random.Random(config.seed * 1000003 + number)
+    birth = START_TIME - timedelta(days=rng.randint(365, 100 * 365))
+    return {
+        "number": number,
+        "version": rng.choice(config.versions),
+        "first": rng.choice(names),
+        "last": rng.choice(names),
+        "kin_first": rng.choice(names),
+        "guarantor": f"{rng.choice(names)}^{rng.choice(names)}",
+        "birth": birth,
+        "sex": rng.choice("MF"),
+        "ssn": f"{rng.randint(100, 899)}-{rng.randint(10, 99)}-{rng.randint(1000, 9999)}",
+        "phone": f"615-{rng.randint(200, 999)}-{rng.randint(1000, 9999)}",
+        "address": f"{rng.randint(1, 9999)} {rng.choice(RG.street_names).upper()} "
+                   f"{rng.choice(RG.street_types).upper()}^^{rng.choice(RG.cities).upper()}^TN^37{rng.randint(0, 999):03}",
+    }
+
+def make_doctor(config, number):
+    rng = random.Random(config.seed * 7919 + number + 1)
+    last, first = rng.choice(RG.last_names), rng.choice(RG.first_names)
+    return f"{(last[:3] + first[:2]).upper()}{number}^{last}^{first}^^^^MD"
+
+def pid_3(patient):
+    """PID-3 in the layout of the patient's HL7 version"""
+    number = patient["number"]
+    if patient["version"] == "2.4":
+        return f"A{1000000 + number}^^^^MR^HOST_VW~{patient['ssn']}^^^^SS^HOST_VW"
+    if patient["version"] == "2.5":
+        return (f"W{10000 + number}^^^UAReg^MR~W{20000000 + number}^^^UAReg^PI"
+                f"~W{300000000 + number}^^^UAReg^AN")
+    return f"W{10000000 + number:08d}"
+
+def make_message(config, rng, index, patient, doctor):
+    """Segments of message index for patient"""
+    timestamp = START_TIME + index * MESSAGE_INTERVAL + timedelta(seconds=rng.randint(0, TIMESTAMP_JITTER))
+    ts = timestamp.strftime("%Y%m%d%H%M%S")
+    birth = patient["birth"]
+    first, last = patient["first"], patient["last"]
+    number = patient["number"]
+    segments = [
+        f"MSH|^~\\&||{rng.choice(FACILITIES)}|||{ts}||{rng.choice(MESSAGE_TYPES)}^NURAS|"
+        f"{index}.{rng.randint(1000000, 9999999)}|P|{patient['version']}",
+        f"EVN|A08|{ts}|||HNUR.ROOM^PARALLON^TRAINING^^^^|{ts[:12]}",
+        f"PID|1||{pid_3(patient)}|X{number}|{last}^{first}^^^^^L||{birth:%Y%m%d}|{patient['sex']}|^^^^^|W|"
+        f"{patient['address']}||{patient['phone']}|615-344-9551|ENG|S||W{400000000 + number}|{patient['ssn']}",
+        f"PV1|1|I|H.AGENCY^H.AGENCY^{rng.randint(100, 399)}|EM|||{doctor}|{doctor}|.DNK^KNOW^DOES^NOT^^^|MEDI"
+        f"||||UNK|WI|N|{doctor}|IN||U",
+    ]
+    if rng.random() < config.nk1_ratio:
+        segments.append(f"NK1|1|{last}^{patient['kin_first']}|SPO|{patient['address']}|{patient['phone']}")
+    if rng.random() < config.gt1_ratio:
+        segments.append(f"GT1|1||{patient['guarantor']}||{patient['address']}|{patient['phone']}")
+
+    fields = {
+        "first": first, "last": last, "ssn": patient["ssn"], "year": birth.year,
+        "month": f"{birth.month:02}", "day": f"{birth.day:02}", "day_number": birth.day,
+        "month_name": MONTH_NAMES[birth.month - 1], "visit": f"{timestamp:%m/%d/%Y}",
+    }
+    set_id = 1
+    for code, value in VITAL_SIGNS:
+        segments.append(f"OBX|{set_id}||{code}||{value(rng)}")
+        set_id += 1
+    for _ in range(max(0, rng.randint(*config.obx) - len(VITAL_SIGNS))):
+        segments.append(f"OBX|{set_id}|TX|SS12345||{rng.choice(NOTES).format(**fields)}")
+        set_id += 1
+    for nte_id in range(1, rng.randint(*config.nte) + 1):
+        segments.append(f"NTE|{nte_id}||{rng.choice(NOTES).format(**fields)}")
+    return segments
+
+def generate_feed(path, config):
+    """
+    Writes config.messages messages to path, one segment per line. Returns
+    the number of distinct patients in the feed.
+    """
+    names = load_names()
+    rng = random.Random(config.seed)
+    doctors = [make_doctor(config, number) for number in range(config.doctors)]
+    seen = 0
+    with open(path, "w", encoding="utf-8", buffering=2**20) as file:
+        for index in range(config.messages):
+            if seen and (seen >= config.patients or rng.random() < config.repeat_ratio):
+                number = rng.randrange(seen)
+            else:
+                number = seen
+                seen += 1
+            patient = make_patient(config, number, names)
+            segments = make_message(config, rng, index, patient, rng.choice(doctors))
+            file.write("\n".join(segments) + "\n")
+    return seen
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic HL7 feed")
+    parser.add_argument("output", nargs="?", default="raw.txt")
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--patients", type=int, help="most distinct patients (default: half the messages)")
+    parser.add_argument("--repeat-ratio", type=float, default=0.5, help="share of messages from returning patients")
+    parser.add_argument("--versions", nargs="+", choices=VERSIONS, default=list(VERSIONS))
+    parser.add_argument("--nk1-ratio", type=float, default=0.3)
+    parser.add_argument("--gt1-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = FeedConfig(args.messages, args.patients, args.repeat_ratio, args.versions,
+                        nk1_ratio=args.nk1_ratio, gt1_ratio=args.gt1_ratio, seed=args.seed)
+    patients = generate_feed(args.output, config)
+    print(f"Wrote {args.messages} messages of {patients} patients to {args.output}")
+
+if __name__ == "__main__":
+    main()